@@ -1,13 +1,16 @@
 import collections
 import operator
+import sys
 
-from mtypes import Sequence, List, Fn, Atom, InvalidTypeError
+from mtypes import (
+    Sequence, List, Vector, Hashmap, Fn, Atom, InvalidTypeError, IndexOutOfRangeError
+)
 import printer
 import reader
 
 
 def f_prn(*args):
-    print(f_pr_str(*args))
+    write_line(args, print_readably=True)
 
 def f_pr_str(*args):
     return " ".join(printer.pr_str(x, print_readably=True) for x in args)
@@ -16,7 +19,16 @@ def f_str(*args):
     return "".join(printer.pr_str(x) for x in args)
 
 def f_println(*args):
-    print(" ".join(printer.pr_str(x) for x in args))
+    write_line(args, print_readably=False)
+
+def write_line(args, print_readably):
+    # Prints straight to stdout rather than building the whole line first.
+    out = sys.stdout
+    for i, x in enumerate(args):
+        if i:
+            out.write(" ")
+        printer.pr_str_to(out, x, print_readably)
+    out.write("\n")
 
 def f_slurp(x):
     with open(x) as f:
@@ -28,12 +40,93 @@ def f_list(*args):
 def f_listp(x, *_):
     return isinstance(x, List)
 
+def f_vector(*args):
+    return Vector(args)
+
+def f_vectorp(x, *_):
+    return isinstance(x, Vector)
+
+def f_nth(x, i):
+    if not 0 <= i < len(x):
+        raise IndexOutOfRangeError("nth: index out of range")
+    return x[i]
+
+def f_conj(x, *args):
+    match x:
+        case Vector():
+            return x.conj(*args)
+        case List():
+            return List(list(reversed(args)) + x.values)
+        case _:
+            raise InvalidTypeError("conj takes a list or vector")
+
+def f_hash_map(*args):
+    if len(args) % 2:
+        raise InvalidTypeError("hash-map takes matched key/value pairs")
+    return Hashmap(zip(args[::2], args[1::2]))
+
+def f_mapp(x, *_):
+    return isinstance(x, Hashmap)
+
+def f_assoc(x, *args):
+    if len(args) % 2:
+        raise InvalidTypeError("assoc takes matched key/value pairs")
+    match x:
+        case Hashmap():
+            return x.assoc(*args)
+        case Vector():
+            for i, v in zip(args[::2], args[1::2]):
+                # Assoc at the count appends, as conj does.
+                if not 0 <= i <= len(x):
+                    raise IndexOutOfRangeError("assoc: index out of range")
+                x = x.assoc(i, v)
+            return x
+        case _:
+            raise InvalidTypeError("assoc takes a hash-map or vector")
+
+def f_dissoc(x, *args):
+    if not isinstance(x, Hashmap):
+        raise InvalidTypeError("dissoc takes a hash-map")
+    return x.dissoc(*args)
+
+def f_get(x, k):
+    # Like Clojure's get, nil for anything that has no k.
+    match x:
+        case Hashmap():
+            return x.values.get(k)
+        case Vector():
+            return x[k] if _is_index(x, k) else None
+        case _:
+            return None
+
+def f_containsp(x, k):
+    match x:
+        case Hashmap():
+            return k in x.values
+        case Vector():
+            return _is_index(x, k)
+        case _:
+            return False
+
+def _is_index(x, k):
+    return type(k) is int and 0 <= k < len(x)
+
+def f_keys(x):
+    if not isinstance(x, Hashmap):
+        raise InvalidTypeError("keys takes a hash-map")
+    return List(list(x.values))
+
+def f_vals(x):
+    if not isinstance(x, Hashmap):
+        raise InvalidTypeError("vals takes a hash-map")
+    return List(list(x.values.values()))
+
 def f_emptyp(x, *_):
     return len(x) == 0
 
 def f_count(x, *_):
     match x:
-        case Sequence():
+        case Sequence() | Hashmap():
             return len(x)
         case _:
             return 0
@@ -82,6 +175,18 @@ ns = {
     "slurp": f_slurp,
     "list": f_list,
     "list?": f_listp,
+    "vector": f_vector,
+    "vector?": f_vectorp,
+    "nth": f_nth,
+    "conj": f_conj,
+    "hash-map": f_hash_map,
+    "map?": f_mapp,
+    "assoc": f_assoc,
+    "dissoc": f_dissoc,
+    "get": f_get,
+    "contains?": f_containsp,
+    "keys": f_keys,
+    "vals": f_vals,
     "empty?": f_emptyp,
     "count": f_count,
     "=": f_eq,
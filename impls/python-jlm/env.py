@@ -4,6 +4,20 @@ from typing import Optional
 import mtypes
 
 
+# Marks a Frame slot whose symbol hasn't been bound yet.
+UNSET = object()
+
+
+class Cell:
+    # Holds the value of a binding in an Env. Rebinding a symbol updates its
+    # cell in place, and a cell is never removed, so code that has looked a
+    # symbol up can keep the cell rather than repeating the lookup.
+    __slots__ = ("value",)
+
+    def __init__(self, value: "mtypes.Node"):
+        self.value = value
+
+
 @dataclass
 class Env:
     outer: Optional["Env"] = None
@@ -22,7 +36,11 @@ class Env:
                         self.set(k, exprs[i])
 
     def set(self, key: "mtypes.Symbol", value: "mtypes.Node"):
-        self.data[key] = value
+        cell = self.data.get(key)
+        if cell is None:
+            self.data[key] = Cell(value)
+        else:
+            cell.value = value
         return value
 
     def find(self, key: "mtypes.Symbol"):
@@ -33,9 +51,22 @@ class Env:
         else:
             return None
 
-    def get(self, key: "mtypes.Symbol"):
+    def cell(self, key: "mtypes.Symbol") -> Cell:
         env = self.find(key)
         if env:
             return env.data[key]
         else:
             raise mtypes.UnknownSymbolError(key)
+
+    def get(self, key: "mtypes.Symbol"):
+        return self.cell(key).value
+
+
+class Frame:
+    # A local env created for a fn* call or let*. Symbols are resolved to
+    # slot indexes when the form is analyzed, so no names are stored here.
+    __slots__ = ("outer", "slots")
+
+    def __init__(self, outer, slots: list):
+        self.outer = outer
+        self.slots = slots
@@ -0,0 +1,76 @@
+import hashlib
+import io
+import os
+import pickle
+
+import reader
+
+
+# Caches the forms read from source files, in the manner of __pycache__: the
+# forms read from dir/name.mal are pickled to dir/__malcache__/name.mal.pickle
+# along with the mtime, size and SHA-256 of the source they were read from.
+# The cache is used if the mtime and size still match, or failing that if
+# the source's hash does, so touching a file doesn't cost a re-read.
+
+CACHE_DIR = "__malcache__"
+
+# Changed whenever the pickled form of the types or this format changes.
+MAGIC = b"mal-forms-2"
+
+
+def cache_path(path: str) -> str:
+    head, tail = os.path.split(path)
+    return os.path.join(head, CACHE_DIR, tail + ".pickle")
+
+
+def read_file(path: str):
+    # Returns the contents of the file at path, read as a single
+    # (do ... nil) form.
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        data = f.read()
+    cached = load(cache_path(path))
+    if cached is not None:
+        mtime_ns, size, digest, form = cached
+        if (mtime_ns, size) == (st.st_mtime_ns, st.st_size):
+            return form
+        if digest == hashlib.sha256(data).digest():
+            return form
+    # Decoded as open() in text mode would, newlines ("\r\n" too) and all.
+    text = io.TextIOWrapper(io.BytesIO(data)).read()
+    form = reader.read_str("(do " + text + "\nnil)")
+    digest = hashlib.sha256(data).digest()
+    dump(cache_path(path), (st.st_mtime_ns, st.st_size, digest, form))
+    return form
+
+
+def load(cache: str):
+    # A missing or corrupted cache (which unpickling can fail on in about any
+    # way: TypeError, UnicodeDecodeError, ModuleNotFoundError, MemoryError,
+    # ...) is ignored, and read_file reads the source again and rewrites it.
+    try:
+        with open(cache, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            mtime_ns, size, digest, form = pickle.load(f)
+    except Exception:
+        return None
+    return mtime_ns, size, digest, form
+
+
+def dump(cache: str, entry):
+    # Failing to write the cache (a read-only directory, say) is not an
+    # error. The file is written under a temporary name and renamed, so a
+    # concurrent reader never sees it half written.
+    tmp = f"{cache}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
@@ -0,0 +1,310 @@
+import collections.abc
+
+from pvector import PersistentVector
+
+
+# A persistent hash map implemented as a hash array mapped trie. Each level
+# of the trie consumes 5 bits of the key's hash. A node keeps a 32-bit bitmap
+# of which of its 32 possible children are present and a dense array holding
+# only those, each either an entry (a (hash, key, value, seq) tuple) or a
+# child node. Keys whose full hashes are equal share a collision node. Updates
+# copy the path from the root to the changed entry and share everything else.
+#
+# The map iterates in the order the keys were added rather than the trie's,
+# which depends on the keys' hashes. A persistent vector alongside the trie
+# holds the entries in that order, and seq is an entry's index in it. dissoc
+# leaves None in the entry's place, and once these outnumber the entries (by
+# more than 32, so small maps aren't rebuilt all the time) the map is rebuilt
+# without them. Iterating is then linear in the map's size, and lazy.
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def _hash(key):
+    return hash(key) & HASH_MASK
+
+
+def _same_key(a, b):
+    return a is b or a == b
+
+
+class _BitmapNode:
+    __slots__ = ("bitmap", "array")
+
+    def __init__(self, bitmap, array):
+        self.bitmap = bitmap
+        self.array = array
+
+    def find(self, shift, h, key):
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit:
+            return None
+        entry = self.array[(self.bitmap & (bit - 1)).bit_count()]
+        if type(entry) is tuple:
+            return entry if _same_key(entry[1], key) else None
+        return entry.find(shift + BITS, h, key)
+
+    def assoc(self, shift, h, key, value, seq):
+        # Returns the new node and the key's entry in it. A key that is
+        # there already keeps its seq.
+        bit = 1 << ((h >> shift) & MASK)
+        i = (self.bitmap & (bit - 1)).bit_count()
+        array = self.array
+        if not self.bitmap & bit:
+            new = (h, key, value, seq)
+            array = array[:i] + [new] + array[i:]
+            return _BitmapNode(self.bitmap | bit, array), new
+        entry = array[i]
+        if type(entry) is tuple:
+            if _same_key(entry[1], key):
+                if entry[2] is value:
+                    return self, entry
+                child = new = (h, key, value, entry[3])
+            else:
+                new = (h, key, value, seq)
+                child = _merge(shift + BITS, entry, new)
+        else:
+            child, new = entry.assoc(shift + BITS, h, key, value, seq)
+            if child is entry:
+                return self, new
+        array = array[:]
+        array[i] = child
+        return _BitmapNode(self.bitmap, array), new
+
+    def without(self, shift, h, key):
+        # Returns self if key is absent, None if the node is left empty, or
+        # an entry tuple if a single entry is left, for the parent to inline.
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit:
+            return self
+        i = (self.bitmap & (bit - 1)).bit_count()
+        entry = self.array[i]
+        if type(entry) is tuple:
+            if not _same_key(entry[1], key):
+                return self
+            child = None
+        else:
+            child = entry.without(shift + BITS, h, key)
+            if child is entry:
+                return self
+        if child is None:
+            array = self.array[:i] + self.array[i + 1 :]
+            if not array:
+                return None
+            if len(array) == 1 and type(array[0]) is tuple:
+                return array[0]
+            return _BitmapNode(self.bitmap ^ bit, array)
+        if len(self.array) == 1 and type(child) is tuple:
+            return child
+        array = self.array[:]
+        array[i] = child
+        return _BitmapNode(self.bitmap, array)
+
+    def entries(self):
+        for entry in self.array:
+            if type(entry) is tuple:
+                yield entry
+            else:
+                yield from entry.entries()
+
+
+class _CollisionNode:
+    __slots__ = ("hash", "array")
+
+    def __init__(self, h, array):
+        self.hash = h
+        self.array = array
+
+    def _index(self, key):
+        for i, entry in enumerate(self.array):
+            if _same_key(entry[1], key):
+                return i
+        return -1
+
+    def find(self, shift, h, key):
+        if h != self.hash:
+            return None
+        i = self._index(key)
+        return self.array[i] if i >= 0 else None
+
+    def assoc(self, shift, h, key, value, seq):
+        if h != self.hash:
+            # Push this node down a level, next to the new entry.
+            node = _BitmapNode(1 << ((self.hash >> shift) & MASK), [self])
+            return node.assoc(shift, h, key, value, seq)
+        i = self._index(key)
+        if i < 0:
+            new = (h, key, value, seq)
+            return _CollisionNode(h, self.array + [new]), new
+        if self.array[i][2] is value:
+            return self, self.array[i]
+        array = self.array[:]
+        array[i] = new = (h, key, value, self.array[i][3])
+        return _CollisionNode(h, array), new
+
+    def without(self, shift, h, key):
+        i = self._index(key) if h == self.hash else -1
+        if i < 0:
+            return self
+        array = self.array[:i] + self.array[i + 1 :]
+        if len(array) == 1:
+            return array[0]
+        return _CollisionNode(h, array)
+
+    def entries(self):
+        return iter(self.array)
+
+
+def _merge(shift, e1, e2):
+    # A node holding two entries whose hashes agree below shift.
+    h1, h2 = e1[0], e2[0]
+    if h1 == h2 or shift >= HASH_BITS:
+        return _CollisionNode(h1, [e1, e2])
+    i1, i2 = (h1 >> shift) & MASK, (h2 >> shift) & MASK
+    if i1 == i2:
+        return _BitmapNode(1 << i1, [_merge(shift + BITS, e1, e2)])
+    array = [e1, e2] if i1 < i2 else [e2, e1]
+    return _BitmapNode((1 << i1) | (1 << i2), array)
+
+
+def _build(shift, entries):
+    # Builds a node from entries with distinct keys in one pass, by bucketing
+    # on the hash bits for this level, without the path copying that
+    # repeated assoc would do.
+    h = entries[0][0]
+    if shift >= HASH_BITS or all(e[0] == h for e in entries):
+        return _CollisionNode(h, entries)
+    buckets = {}
+    for e in entries:
+        buckets.setdefault((e[0] >> shift) & MASK, []).append(e)
+    bitmap = 0
+    array = []
+    for i in sorted(buckets):
+        bucket = buckets[i]
+        bitmap |= 1 << i
+        if len(bucket) == 1:
+            array.append(bucket[0])
+        else:
+            array.append(_build(shift + BITS, bucket))
+    return _BitmapNode(bitmap, array)
+
+
+_EMPTY_NODE = _BitmapNode(0, [])
+_EMPTY_ORDER = PersistentVector()
+
+
+class PersistentHashMap(collections.abc.Mapping):
+    __slots__ = ("_count", "_root", "_order")
+
+    def __init__(self, items=()):
+        # Later values win over earlier ones for the same key, as with dict,
+        # and the key keeps the place where it first came.
+        items = dict(items)
+        entries = [(_hash(k), k, v, i) for i, (k, v) in enumerate(items.items())]
+        self._count = len(entries)
+        self._root = _build(0, entries) if entries else _EMPTY_NODE
+        self._order = PersistentVector.from_list(entries)
+
+    @classmethod
+    def _make(cls, count, root, order):
+        m = cls.__new__(cls)
+        m._count = count
+        m._root = root
+        m._order = order
+        return m
+
+    def _entries(self):
+        for entry in self._order:
+            if entry is not None:
+                yield entry
+
+    def assoc(self, key, value) -> "PersistentHashMap":
+        h = _hash(key)
+        order = self._order
+        root, entry = self._root.assoc(0, h, key, value, len(order))
+        if root is self._root:
+            return self
+        added = entry[3] == len(order)
+        return self._make(self._count + added, root, order.assoc(entry[3], entry))
+
+    def dissoc(self, key) -> "PersistentHashMap":
+        h = _hash(key)
+        entry = self._root.find(0, h, key)
+        if entry is None:
+            return self
+        count = self._count - 1
+        order = self._order
+        if len(order) - count > count + 32:
+            # More holes than entries: renumber the entries that are left.
+            seq = entry[3]
+            entries = [
+                (e[0], e[1], e[2], i)
+                for i, e in enumerate(e for e in self._entries() if e[3] != seq)
+            ]
+            root = _build(0, entries) if entries else _EMPTY_NODE
+            return self._make(count, root, PersistentVector.from_list(entries))
+        root = self._root.without(0, h, key)
+        if root is None:
+            return self._make(0, _EMPTY_NODE, _EMPTY_ORDER)
+        if type(root) is tuple:
+            root = _BitmapNode(1 << (root[0] & MASK), [root])
+        return self._make(count, root, order.assoc(entry[3], None))
+
+    def __getitem__(self, key):
+        entry = self._root.find(0, _hash(key), key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[2]
+
+    def get(self, key, default=None):
+        entry = self._root.find(0, _hash(key), key)
+        return default if entry is None else entry[2]
+
+    def __contains__(self, key):
+        return self._root.find(0, _hash(key), key) is not None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for entry in self._entries():
+            yield entry[1]
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Mapping):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        missing = object()
+        return all(other.get(e[1], missing) == e[2] for e in self._root.entries())
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # The trie is laid out by the keys' hashes, which (for strings)
+        # differ from one process to the next, so it is rebuilt.
+        return type(self), (list(self.items()),)
+
+    def __repr__(self):
+        return f"PersistentHashMap({dict(self.items())!r})"
+
+
+class _ItemsView(collections.abc.ItemsView):
+    def __iter__(self):
+        for entry in self._mapping._entries():
+            yield entry[1], entry[2]
+
+
+class _ValuesView(collections.abc.ValuesView):
+    def __iter__(self):
+        for entry in self._mapping._entries():
+            yield entry[2]
@@ -1,8 +1,11 @@
 import collections
+import zlib
 from dataclasses import dataclass, field
 from typing import Any
 
 import env
+from hamt import PersistentHashMap
+from pvector import PersistentVector
 
 
 class UnknownSymbolError(RuntimeError):
@@ -17,34 +20,77 @@ class InvalidTypeError(RuntimeError):
     pass
 
 
-@dataclass
-class Node:
+class ArityError(RuntimeError):
+    pass
+
+
+class IndexOutOfRangeError(RuntimeError):
     pass
 
 
 @dataclass
-class Symbol(Node):
-    value: str
+class Node:
+    __slots__ = ()
 
-    def __str__(self):
-        return self.value
+
+class Interned(Node):
+    # Base for Symbol and Keyword: there is one canonical, immutable instance
+    # per name, so equality is by identity and never has to look at the name.
+    # The hash is worked out from the name once, when the instance is made,
+    # so that it (and a hash map's layout) is the same in every run.
+    __slots__ = ("value", "_hash")
+    __match_args__ = ("value",)
+
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
 
     def __hash__(self):
-        return hash(self.value)
+        return self._hash
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._instances = {}
 
-@dataclass
-class Keyword(Node):
-    value: str
+    def __new__(cls, value: str):
+        try:
+            return cls._instances[value]
+        except KeyError:
+            self = object.__new__(cls)
+            object.__setattr__(self, "value", value)
+            object.__setattr__(self, "_hash", zlib.crc32(str(self).encode()))
+            return cls._instances.setdefault(value, self)
+
+    def __init__(self, value: str):
+        # The instance was already set up by __new__.
+        pass
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return type(self), (self.value,)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.value!r})"
+
+
+class Symbol(Interned):
+    __slots__ = ()
 
     def __str__(self):
-        return ":" + self.value
+        return self.value
 
-    def __hash__(self):
-        return hash(self.value)
 
+class Keyword(Interned):
+    __slots__ = ()
 
-@dataclass
+    def __str__(self):
+        return ":" + self.value
+
+
+@dataclass(slots=True)
 class Sequence(Node, collections.abc.Sequence):
     values: list
 
@@ -54,20 +100,60 @@ class Sequence(Node, collections.abc.Sequence):
     def __len__(self):
         return len(self.values)
 
+    def __iter__(self):
+        return iter(self.values)
 
-@dataclass
+    def __reduce__(self):
+        # Quicker to unpickle than the state dict that slots would use.
+        return type(self), (self.values,)
+
+
+@dataclass(slots=True)
 class List(Sequence):
     pass
 
 
-@dataclass
+@dataclass(slots=True)
 class Vector(Sequence):
-    pass
+    # Backed by a PersistentVector, so conj and assoc return a new Vector
+    # that shares structure with this one instead of copying it.
+    values: PersistentVector
 
+    def __post_init__(self):
+        if not isinstance(self.values, PersistentVector):
+            self.values = PersistentVector(self.values)
 
-@dataclass
+    def conj(self, *xs) -> "Vector":
+        values = self.values
+        for x in xs:
+            values = values.conj(x)
+        return Vector(values)
+
+    def assoc(self, i: int, x) -> "Vector":
+        return Vector(self.values.assoc(i, x))
+
+
+@dataclass(slots=True)
 class Hashmap(Node, collections.abc.Mapping):
-    values: dict
+    # Backed by a PersistentHashMap, so assoc and dissoc return a new Hashmap
+    # that shares structure with this one instead of copying it.
+    values: PersistentHashMap
+
+    def __post_init__(self):
+        if not isinstance(self.values, PersistentHashMap):
+            self.values = PersistentHashMap(self.values)
+
+    def assoc(self, *kvs) -> "Hashmap":
+        values = self.values
+        for k, v in zip(kvs[::2], kvs[1::2]):
+            values = values.assoc(k, v)
+        return Hashmap(values)
+
+    def dissoc(self, *ks) -> "Hashmap":
+        values = self.values
+        for k in ks:
+            values = values.dissoc(k)
+        return Hashmap(values)
 
     def __getitem__(self, k):
         return self.values[k]
@@ -78,18 +164,26 @@ class Hashmap(Node, collections.abc.Mapping):
     def __len__(self):
         return len(self.values)
 
+    def __reduce__(self):
+        return type(self), (self.values,)
 
-@dataclass
+
+@dataclass(slots=True)
 class Fn(Node):
     ast: Node
     params: Sequence(Symbol)
     env: "env.Env"
     fn: collections.abc.Callable
+    code: collections.abc.Callable = None
+    bind: collections.abc.Callable = None
+    # Number of parameters before any "&", and whether there is one.
+    arity: int = None
+    variadic: bool = False
 
     def __str__(self):
         return "#<function>"
 
 
-@dataclass
+@dataclass(slots=True)
 class Atom:
     value: Any
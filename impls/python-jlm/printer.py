@@ -1,4 +1,5 @@
 import collections.abc
+import io
 import itertools
 import re
 
@@ -11,18 +12,61 @@ escapes_map = {
     '"': '\\"',
     "\n": "\\n",
 }
+end_of_items = object()
 
 
 def pr_str(x, print_readably=False) -> str:
     match x:
-        case List():
-            return "(" + pr_str_sequence(x, print_readably) + ")"
-        case Vector():
-            return "[" + pr_str_sequence(x, print_readably) + "]"
-        case Hashmap():
-            return "{" + pr_str_hashmap(x, print_readably) + "}"
-        case Atom(value):
-            return "(atom " + pr_str(value) + ")"
+        case List() | Vector() | Hashmap() | Atom():
+            out = io.StringIO()
+            pr_str_to(out, x, print_readably)
+            return out.getvalue()
+        case _:
+            return pr_str_scalar(x, print_readably)
+
+
+def pr_str_to(stream, x, print_readably=False):
+    # Writes x to stream piece by piece. Nested collections are walked with
+    # an explicit stack of [items iterator, closing text, first item?]
+    # frames rather than by recursion, so depth is bounded only by memory and
+    # the printed form of a collection is never built up as one string.
+    write = stream.write
+    stack = []
+    while True:
+        match x:
+            case List():
+                write("(")
+                stack.append([iter(x), ")", True])
+            case Vector():
+                write("[")
+                stack.append([iter(x), "]", True])
+            case Hashmap():
+                write("{")
+                items = itertools.chain.from_iterable(x.values.items())
+                stack.append([items, "}", True])
+            case Atom(value):
+                write("(atom ")
+                stack.append([iter((value,)), ")", True])
+            case _:
+                write(pr_str_scalar(x, print_readably))
+        while stack:
+            frame = stack[-1]
+            x = next(frame[0], end_of_items)
+            if x is end_of_items:
+                write(frame[1])
+                stack.pop()
+                continue
+            if frame[2]:
+                frame[2] = False
+            else:
+                write(" ")
+            break
+        else:
+            return
+
+
+def pr_str_scalar(x, print_readably=False) -> str:
+    match x:
         case str():
             if print_readably:
                 x = escapes_pat.sub(lambda m: escapes_map[m.group()], x)
@@ -38,10 +82,3 @@ def pr_str(x, print_readably=False) -> str:
             return "false"
         case _:
             return str(x)
-
-def pr_str_sequence(x: Sequence, print_readably):
-    return " ".join(pr_str(i, print_readably) for i in x)
-
-def pr_str_hashmap(x: Hashmap, print_readably):
-    it = itertools.chain.from_iterable(x.values.items())
-    return pr_str_sequence(it, print_readably)
@@ -0,0 +1,172 @@
+import collections.abc
+
+
+# A persistent vector in the style of Clojure's: a trie with 32-way branching
+# whose leaves hold the elements, plus a separate "tail" leaf for the last
+# (up to 32) elements so that appending usually touches nothing but the
+# tail. Updates copy only the path from the root to the changed leaf and
+# share everything else with the previous version.
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+# The root of every vector short enough to fit in its tail. Nodes are never
+# changed once built, so they can all share one.
+_EMPTY_ROOT = []
+
+
+class PersistentVector(collections.abc.Sequence):
+    __slots__ = ("_count", "_shift", "_root", "_tail")
+
+    def __init__(self, items=()):
+        items = list(items)
+        count = len(items)
+        shift = BITS
+        if count <= WIDTH:
+            root, tail = _EMPTY_ROOT, items
+        else:
+            # Pack every full leaf before the tail, then group nodes 32 at a
+            # time until a single root is left.
+            tail_offset = ((count - 1) >> BITS) << BITS
+            root = [items[i : i + WIDTH] for i in range(0, tail_offset, WIDTH)]
+            while len(root) > WIDTH:
+                root = [root[i : i + WIDTH] for i in range(0, len(root), WIDTH)]
+                shift += BITS
+            tail = items[tail_offset:]
+        self._count = count
+        self._shift = shift
+        self._root = root
+        self._tail = tail
+
+    @classmethod
+    def from_list(cls, items: list) -> "PersistentVector":
+        # Like the constructor, but a short list is used as the tail as it
+        # is rather than copied, so the caller must not change it after.
+        if len(items) <= WIDTH:
+            return cls._make(len(items), BITS, _EMPTY_ROOT, items)
+        return cls(items)
+
+    @classmethod
+    def _make(cls, count, shift, root, tail):
+        v = cls.__new__(cls)
+        v._count = count
+        v._shift = shift
+        v._root = root
+        v._tail = tail
+        return v
+
+    def _tail_offset(self):
+        if self._count < WIDTH:
+            return 0
+        return ((self._count - 1) >> BITS) << BITS
+
+    def _leaf_for(self, i):
+        if i >= self._tail_offset():
+            return self._tail
+        node = self._root
+        for level in range(self._shift, 0, -BITS):
+            node = node[(i >> level) & MASK]
+        return node
+
+    def nth(self, i):
+        if not 0 <= i < self._count:
+            raise IndexError("vector index out of range")
+        return self._leaf_for(i)[i & MASK]
+
+    def conj(self, x):
+        count, shift, root, tail = self._count, self._shift, self._root, self._tail
+        if count - self._tail_offset() < WIDTH:
+            return self._make(count + 1, shift, root, tail + [x])
+        # The tail is full: push it into the trie, growing a new root level
+        # if the current one has no room left.
+        if (count >> BITS) > (1 << shift):
+            root = [root, _new_path(shift, tail)]
+            shift += BITS
+        else:
+            root = _push_tail(count, shift, root, tail)
+        return self._make(count + 1, shift, root, [x])
+
+    def assoc(self, i, x):
+        count = self._count
+        if i == count:
+            return self.conj(x)
+        if not 0 <= i < count:
+            raise IndexError("vector index out of range")
+        if i >= self._tail_offset():
+            tail = self._tail[:]
+            tail[i & MASK] = x
+            return self._make(count, self._shift, self._root, tail)
+        root = _assoc(self._shift, self._root, i, x)
+        return self._make(count, self._shift, root, self._tail)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += self._count
+        return self.nth(i)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for leaf in _leaves(self._shift, self._root):
+            yield from leaf
+        yield from self._tail
+
+    def __eq__(self, other):
+        if not isinstance(other, PersistentVector):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            x == y for x, y in zip(self, other)
+        )
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return type(self), (list(self),)
+
+    def __repr__(self):
+        return f"PersistentVector({list(self)!r})"
+
+
+def _new_path(level, node):
+    while level > 0:
+        node = [node]
+        level -= BITS
+    return node
+
+
+def _push_tail(count, level, parent, tail):
+    i = ((count - 1) >> level) & MASK
+    node = parent[:]
+    if level == BITS:
+        child = tail
+    elif i < len(parent):
+        child = _push_tail(count, level - BITS, parent[i], tail)
+    else:
+        child = _new_path(level - BITS, tail)
+    if i < len(node):
+        node[i] = child
+    else:
+        node.append(child)
+    return node
+
+
+def _assoc(level, node, i, x):
+    node = node[:]
+    if level == 0:
+        node[i & MASK] = x
+    else:
+        j = (i >> level) & MASK
+        node[j] = _assoc(level - BITS, node[j], i, x)
+    return node
+
+
+def _leaves(level, node):
+    if level == 0:
+        yield node
+    else:
+        for child in node:
+            yield from _leaves(level - BITS, child)
@@ -1,7 +1,9 @@
 from dataclasses import dataclass, field
 import re
-from typing import List
+from typing import Optional
 
+from hamt import PersistentHashMap
+from pvector import PersistentVector
 import mtypes
 
 
@@ -19,33 +21,78 @@ class EmptyExpression(RuntimeError):
 
 @dataclass
 class Reader:
+    # Scans tokens from the source on demand. A token is a (kind, value)
+    # pair: kind is the name of the token_pat group that matched, and value
+    # is the delimiter or macro text, or the already converted atom.
 
-    tokens: List[str]
+    source: str
     position: int = 0
+    token: Optional[tuple] = None
 
-    def next(self) -> str:
+    def next(self) -> tuple:
         t = self.peek()
-        self.position += 1
+        self.token = None
         return t
 
-    def peek(self) -> str:
-        try:
-            return self.tokens[self.position]
-        except IndexError:
+    def peek(self) -> tuple:
+        token = self.token
+        if token is None:
+            token = self.token = self.scan()
+        if token[0] == "eof":
             raise UnbalancedParenthesesError
+        return token
+
+    def at_eof(self) -> bool:
+        if self.token is None:
+            self.token = self.scan()
+        return self.token[0] == "eof"
+
+    def scan(self) -> tuple:
+        m = tokens_pat.match(self.source, self.position)
+        self.position = m.end()
+        kind = m.lastgroup
+        t = m.group(kind)
+        if kind == "string":
+            t = t[1:-1]
+            if "\\" in t:
+                t = unescapes_pat.sub(lambda m: unescapes_map[m.group()[1]], t)
+            return kind, t
+        elif kind == "unterminated":
+            raise UnbalancedQuoteError
+        elif kind == "keyword":
+            return kind, mtypes.Keyword(t[1:])
+        elif kind == "int":
+            return kind, int(t)
+        elif kind == "symbol":
+            if t in constants:
+                return kind, constants[t]
+            return kind, mtypes.Symbol(t)
+        return kind, t
 
 
 def read_str(s):
-    tokens = tokenize(s)
-    if not tokens:
+    r = Reader(s)
+    if r.at_eof():
         raise EmptyExpression
-    r = Reader(tokens)
     return read_form(r)
 
 
+# Whitespace, commas and comments are skipped as part of matching the next
+# token, so the source is scanned once, left to right, with no token list.
+atom_chars = r"""[^\s\[\]{}('"`,;)]"""
 tokens_pat = re.compile(
-    # Final + in last group changed from original * to avoid trailing empty token.
-    r"""[\s,]*(~@|[\[\]{}()'`~^@]|"(?:\\.|[^\\"])*"?|;.*|[^\s\[\]{}('"`,;)]+)"""
+    rf"""(?:[\s,]+|;.*)*
+    (?:
+        (?P<delimiter>[\[\]{{}}()])
+      | (?P<macro>~@|['`~^@])
+      | (?P<string>"(?:\\.|[^\\"])*")
+      | (?P<unterminated>")
+      | (?P<keyword>:{atom_chars}+)
+      | (?P<int>-?\d+(?!{atom_chars}))
+      | (?P<symbol>{atom_chars}+)
+      | (?P<eof>\Z)
+    )""",
+    re.VERBOSE,
 )
 unescapes_pat = re.compile(r'\\[\\"n]')
 unescapes_map = {
@@ -61,29 +108,34 @@ macro_map = {
     "@": "deref",
     "^": "with-meta",
 }
-
-def tokenize(s) -> List[str]:
-    return [t for t in tokens_pat.findall(s) if not t.startswith(";")]
+constants = {
+    "nil": None,
+    "true": True,
+    "false": False,
+}
 
 
 def read_form(r: Reader):
-    t = r.peek()
-    if t == "(":
-        return read_list(r)
-    elif t == "[":
-        return read_vector(r)
-    elif t == "{":
-        return read_hashmap(r)
-    elif m := macro_map.get(t, None):
-        return read_macro(r, m)
-    else:
-        return read_atom(r)
+    kind, t = r.next()
+    if kind == "delimiter":
+        if t == "(":
+            return read_list(r)
+        elif t == "[":
+            return read_vector(r)
+        elif t == "{":
+            return read_hashmap(r)
+        # A stray closing delimiter is read as a symbol.
+        return mtypes.Symbol(t)
+    elif kind == "macro":
+        return read_macro(r, macro_map[t])
+    return t
 
 
 def read_sequence(r: Reader, end_tok: str):
-    r.next()
+    # The opening delimiter has already been consumed by read_form.
     v = []
-    while r.peek() != end_tok:
+    end = ("delimiter", end_tok)
+    while r.peek() != end:
         v.append(read_form(r))
     r.next()
     return v
@@ -96,45 +148,16 @@ def read_list(r: Reader):
 
 def read_vector(r: Reader):
     v = read_sequence(r, "]")
-    return mtypes.Vector(v)
+    return mtypes.Vector(PersistentVector.from_list(v))
 
 
 def read_hashmap(r: Reader):
     v = read_sequence(r, "}")
-    m = dict(zip(v[::2], v[1::2]))
+    m = PersistentHashMap(zip(v[::2], v[1::2]))
     return mtypes.Hashmap(m)
 
 
-def read_atom(r: Reader):
-    t = r.next()
-    if t == "":
-        return ""
-    elif t[0] == '"':
-        if len(t) < 2 or t[-1] != '"':
-            raise UnbalancedQuoteError
-        t = t[1:-1]
-        if m := re.search(r"\\*$", t):
-            a, b = m.span()
-            if (b - a) % 2 == 1:
-                raise UnbalancedQuoteError
-        t = unescapes_pat.sub(lambda m: unescapes_map[m.group()[1]], t)
-        return t
-    elif re.match(r":.", t):
-        return mtypes.Keyword(t[1:])
-    elif re.match(r"-?\d+$", t):
-        return int(t)
-    elif t == "nil":
-        return None
-    elif t == "true":
-        return True
-    elif t == "false":
-        return False
-    else:
-        return mtypes.Symbol(t)
-
-
 def read_macro(r: Reader, symbol: str):
-    r.next()
     if symbol == "with-meta":
         meta = read_form(r)
         form = read_form(r)
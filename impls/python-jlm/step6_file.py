@@ -1,9 +1,10 @@
-import collections.abc
+import os
 import sys
 from typing import Optional
 
 import core
-from env import Env
+from env import Env, Frame, UNSET
+import formcache
 from mtypes import (
     Node,
     Symbol,
@@ -15,6 +16,8 @@ from mtypes import (
     UnknownSymbolError,
     InvalidSyntaxError,
     InvalidTypeError,
+    ArityError,
+    IndexOutOfRangeError,
 )
 import printer
 import reader
@@ -25,89 +28,501 @@ def READ(x: str) -> Node:
 
 
 def EVAL(ast: Node, env: Env) -> Node:
-    while True:
-        match ast:
-            case List([]):
-                return ast
-            case List([Symbol("def!"), Symbol() as key, expr]):
-                return env.set(key, EVAL(expr, env))
-            case List([Symbol("def!"), *_]):
-                raise InvalidSyntaxError("def! takes a symbol and an expression")
-            case List([Symbol("let*"), Sequence(binds), expr]):
-                if len(binds) % 2:
-                    raise InvalidSyntaxError("let* bindings must be matched pairs")
-                ast = expr
-                env = Env(env)
-                for bsym, bexpr in zip(binds[::2], binds[1::2]):
-                    match bsym:
-                        case Symbol():
-                            env.set(bsym, EVAL(bexpr, env))
-                        case _:
-                            raise InvalidSyntaxError(
-                                "let* can only bind to a symbol"
-                            )
-            case List([Symbol("let*"), *_]):
-                raise InvalidSyntaxError(
-                    "let* takes a binding list and an expression"
-                )
-            case List([Symbol("do"), *nodes]):
-                for node in nodes[:-1]:
-                    EVAL(node, env)
-                ast = nodes[-1]
-            case List([Symbol("if"), cond, b_true, b_false]):
-                ast = eval_if(cond, b_true, b_false, env)
-            case List([Symbol("if"), cond, b_true]):
-                ast = eval_if(cond, b_true, None, env)
-            case List([Symbol("if"), *_]):
-                raise InvalidSyntaxError(
-                    "if takes a condition and 1 or 2 branch expressions"
-                )
-            case List([Symbol("fn*"), Sequence() as params, body]):
-                def fn(*args):
-                    env_inner = Env(env, binds=params, exprs=args)
-                    return EVAL(body, env_inner)
-                return Fn(ast=body, params=params, env=env, fn=fn)
-            case List():
-                # Apply
-                f, *args = eval_ast(ast, env)
-                match f:
-                    case collections.abc.Callable():
-                        return f(*args)
-                    case Fn():
-                        ast = f.ast
-                        env = Env(f.env, binds=f.params, exprs=args)
-                    case _:
-                        raise InvalidTypeError(
-                            "attempted to call a non-function"
-                        )
-            case _:
-                return eval_ast(ast, env)
+    return evaluate(analyze(ast, None, tail=True), env)
 
 
 def PRINT(ast: Node) -> str:
     return printer.pr_str(ast, print_readably=True)
 
 
-def eval_ast(node: Node, env: Env):
-    match node:
+# The evaluator works in two stages: analyze() turns a form into a tree of
+# closures taking an env, once, and run() executes that tree. Code in tail
+# position returns a TailCall instead of calling an Fn, and run() loops on
+# those so Mal-level tail calls don't grow the Python stack.
+#
+# Analysis also resolves local symbols. Each fn* and let* gets a Scope that
+# assigns its names (params, bindings and any def! targets) a slot index, and
+# at runtime it gets a Frame holding those slots. A reference to a local is
+# then a walk up a known number of frames and a list index. Only the global
+# env is a dict, and each reference to a global keeps the Cell it last
+# resolved to, so it only goes back to the dict when it runs in a different
+# env.
+#
+# Running the closures directly nests a few Python frames per Mal call that
+# isn't a tail call, so deep non-tail recursion hits Python's recursion
+# limit. With MAL_EVAL=stack in the environment, run_stack() is used
+# instead. It evaluates the "step" that non-leaf codes carry alongside
+# themselves: a generator that yields (code, env) for each subform it needs
+# the value of and returns its result, or a TailCall for the form whose
+# value is its own. The generators waiting on a value are kept on a list,
+# so recursion depth is bounded by memory rather than the Python stack.
+
+
+class TailCall:
+    __slots__ = ("code", "env")
+
+    def __init__(self, code, env: Env):
+        self.code = code
+        self.env = env
+
+
+class Scope:
+    __slots__ = ("names", "outer", "depth")
+
+    def __init__(self, outer: Optional["Scope"]):
+        self.names = {}
+        self.outer = outer
+        # Number of frames between this scope and the global env.
+        self.depth = 1 if outer is None else outer.depth + 1
+
+    def define(self, key: Symbol) -> int:
+        return self.names.setdefault(key, len(self.names))
+
+    def addresses(self, key: Symbol):
+        scope, depth = self, 0
+        while scope is not None:
+            if key in scope.names:
+                yield depth, scope.names[key]
+            scope, depth = scope.outer, depth + 1
+
+
+def run(code, env: Env) -> Node:
+    result = code(env)
+    while type(result) is TailCall:
+        result = result.code(result.env)
+    return result
+
+
+def run_stack(code, env: Env) -> Node:
+    stack = []
+    while True:
+        step = getattr(code, "step", None)
+        if step is None:
+            value = code(env)
+        else:
+            stack.append(step(env))
+            value = None
+        # Resume the innermost waiting step with value until one asks for
+        # another subform to be evaluated.
+        while True:
+            if not stack:
+                return value
+            try:
+                code, env = stack[-1].send(value)
+                break
+            except StopIteration as stop:
+                stack.pop()
+                value = stop.value
+                if type(value) is TailCall:
+                    code, env = value.code, value.env
+                    break
+
+
+def analyze(ast: Node, scope: Optional[Scope], tail: bool = False):
+    match ast:
         case Symbol():
-            return env.get(node)
-        case List(values):
-            return List([EVAL(v, env) for v in values])
+            return analyze_symbol(ast, scope)
+        case List([]):
+            return lambda env: ast
+        case List([head, *_]):
+            if type(head) is Symbol and (form := special_forms.get(head)):
+                return form(ast, scope, tail)
+            return analyze_apply(ast, scope, tail)
         case Vector(values):
-            return Vector([EVAL(v, env) for v in values])
+            codes = [analyze(v, scope) for v in values]
+            def vector(env):
+                return Vector([c(env) for c in codes])
+            def step(env):
+                values = []
+                for c in codes:
+                    values.append((yield c, env))
+                return Vector(values)
+            vector.step = step
+            return vector
         case Hashmap(values):
-            return Hashmap({k: EVAL(v, env) for k, v in values.items()})
+            codes = {k: analyze(v, scope) for k, v in values.items()}
+            def hashmap(env):
+                return Hashmap({k: c(env) for k, c in codes.items()})
+            def step(env):
+                values = {}
+                for k, c in codes.items():
+                    values[k] = yield c, env
+                return Hashmap(values)
+            hashmap.step = step
+            return hashmap
         case _:
-            return node
+            return lambda env: ast
+
+
+# Special forms are looked up by their (interned) head symbol. Each handler
+# takes the whole form, the current scope and whether the form is in tail
+# position, and returns the analyzed code, with a step for run_stack() if it
+# evaluates any subforms.
+special_forms = {}
+
+
+def special_form(name: str):
+    def register(handler):
+        special_forms[Symbol(name)] = handler
+        return handler
+    return register
 
 
-def eval_if(cond: Node, b_true: Node, b_false: Node, env: Env):
-    result = EVAL(cond, env)
-    if result is None or result is False:
-        return b_false
+def local_defs(nodes):
+    # Symbols that def! would set in the env these nodes are evaluated in.
+    # fn* and let* forms evaluate their contents in a new env, so they are
+    # not descended into.
+    for node in nodes:
+        match node:
+            case List([Symbol("fn*") | Symbol("let*"), *_]):
+                pass
+            case List([Symbol("def!"), Symbol() as key, *rest]):
+                yield key
+                yield from local_defs(rest)
+            case Sequence():
+                yield from local_defs(node)
+            case Hashmap(values):
+                yield from local_defs(values.values())
+
+
+def global_ref(key: Symbol, depth: int = 0):
+    # Looks key up in the global env, depth frames out from the env the code
+    # runs in. The Cell found is kept for as long as the code keeps running
+    # in the same global env: the global env has no outer env that it could
+    # shadow, and its cells are updated in place, never replaced, so only a
+    # different env can give a different Cell.
+    cached_env = cell = None
+    def miss(env: Env):
+        nonlocal cached_env, cell
+        cell = env.cell(key)
+        cached_env = env
+        return cell.value
+    if depth == 0:
+        def lookup(env):
+            if env is cached_env:
+                return cell.value
+            return miss(env)
+    elif depth == 1:
+        def lookup(env):
+            env = env.outer
+            if env is cached_env:
+                return cell.value
+            return miss(env)
     else:
-        return b_true
+        def lookup(env):
+            for _ in range(depth):
+                env = env.outer
+            if env is cached_env:
+                return cell.value
+            return miss(env)
+    return lookup
+
+
+def analyze_symbol(key: Symbol, scope: Optional[Scope]):
+    # A slot that hasn't been set yet (a let* binding still being evaluated,
+    # a def! that hasn't run) is skipped, just as a missing key in a dict env
+    # would be, so the fallback continues outwards to the global env.
+    if scope is None:
+        return global_ref(key)
+    addresses = list(scope.addresses(key))
+    global_depth = scope.depth
+    lookup = global_ref(key, global_depth)
+    def resolve(env):
+        for depth, index in addresses:
+            frame = env
+            for _ in range(depth):
+                frame = frame.outer
+            value = frame.slots[index]
+            if value is not UNSET:
+                return value
+        return lookup(env)
+    match addresses:
+        case []:
+            return lookup
+        case [(0, index), *_]:
+            def symbol(env):
+                value = env.slots[index]
+                if value is not UNSET:
+                    return value
+                return resolve(env)
+            return symbol
+        case [(1, index), *_]:
+            def symbol(env):
+                value = env.outer.slots[index]
+                if value is not UNSET:
+                    return value
+                return resolve(env)
+            return symbol
+        case _:
+            return resolve
+
+
+@special_form("def!")
+def analyze_def(ast: List, scope: Optional[Scope], tail: bool):
+    match ast:
+        case [_, Symbol() as key, expr]:
+            pass
+        case _:
+            raise InvalidSyntaxError("def! takes a symbol and an expression")
+    value = analyze(expr, scope)
+    if scope is None:
+        def def_(env):
+            return env.set(key, value(env))
+        def step(env):
+            return env.set(key, (yield value, env))
+        def_.step = step
+        return def_
+    index = scope.define(key)
+    def def_(env):
+        result = env.slots[index] = value(env)
+        return result
+    def step(env):
+        result = env.slots[index] = yield value, env
+        return result
+    def_.step = step
+    return def_
+
+
+@special_form("let*")
+def analyze_let(ast: List, scope: Optional[Scope], tail: bool):
+    match ast:
+        case [_, Sequence(binds), expr]:
+            pass
+        case _:
+            raise InvalidSyntaxError(
+                "let* takes a binding list and an expression"
+            )
+    if len(binds) % 2:
+        raise InvalidSyntaxError("let* bindings must be matched pairs")
+    scope = Scope(scope)
+    bsyms, bexprs = binds[::2], binds[1::2]
+    for bsym in bsyms:
+        match bsym:
+            case Symbol():
+                scope.define(bsym)
+            case _:
+                raise InvalidSyntaxError("let* can only bind to a symbol")
+    for key in local_defs([*bexprs, expr]):
+        scope.define(key)
+    pairs = [
+        (scope.names[bsym], analyze(bexpr, scope))
+        for bsym, bexpr in zip(bsyms, bexprs)
+    ]
+    body = analyze(expr, scope, tail)
+    size = len(scope.names)
+    def let(env):
+        env = Frame(env, [UNSET] * size)
+        slots = env.slots
+        for index, value in pairs:
+            slots[index] = value(env)
+        return body(env)
+    def step(env):
+        env = Frame(env, [UNSET] * size)
+        slots = env.slots
+        for index, value in pairs:
+            slots[index] = yield value, env
+        return TailCall(body, env)
+    let.step = step
+    return let
+
+
+@special_form("do")
+def analyze_do(ast: List, scope: Optional[Scope], tail: bool):
+    nodes = ast[1:]
+    if not nodes:
+        return lambda env: None
+    *init, last = nodes
+    init = [analyze(node, scope) for node in init]
+    last = analyze(last, scope, tail)
+    def do(env):
+        for code in init:
+            code(env)
+        return last(env)
+    def step(env):
+        for code in init:
+            yield code, env
+        return TailCall(last, env)
+    do.step = step
+    return do
+
+
+@special_form("if")
+def analyze_if(ast: List, scope: Optional[Scope], tail: bool):
+    match ast:
+        case [_, cond, b_true, b_false]:
+            pass
+        case [_, cond, b_true]:
+            b_false = None
+        case _:
+            raise InvalidSyntaxError(
+                "if takes a condition and 1 or 2 branch expressions"
+            )
+    cond = analyze(cond, scope)
+    b_true = analyze(b_true, scope, tail)
+    b_false = analyze(b_false, scope, tail)
+    def if_(env):
+        result = cond(env)
+        if result is None or result is False:
+            return b_false(env)
+        else:
+            return b_true(env)
+    def step(env):
+        result = yield cond, env
+        if result is None or result is False:
+            return TailCall(b_false, env)
+        else:
+            return TailCall(b_true, env)
+    if_.step = step
+    return if_
+
+
+@special_form("fn*")
+def analyze_fn(ast: List, scope: Optional[Scope], tail: bool):
+    match ast:
+        case [_, Sequence() as params, body]:
+            pass
+        case _:
+            raise InvalidSyntaxError("fn* takes a parameter list and a body")
+    scope = Scope(scope)
+    nfixed = len(params)
+    variadic = False
+    for i, param in enumerate(params):
+        match param:
+            case Symbol("&"):
+                nfixed = i
+                variadic = True
+                scope.define(params[i + 1])
+                break
+            case Symbol():
+                scope.define(param)
+            case _:
+                raise InvalidSyntaxError("fn* can only bind to a symbol")
+    for key in local_defs([body]):
+        scope.define(key)
+    code = analyze(body, scope, tail=True)
+    bind = binder(nfixed, variadic, len(scope.names))
+    def fn_(env):
+        def fn(*args):
+            return evaluate(code, Frame(env, bind(list(args))))
+        return Fn(body, params, env, fn, code, bind, nfixed, variadic)
+    return fn_
+
+
+def binder(arity: int, variadic: bool, size: int):
+    # Returns bind(args), which checks the number of args against the
+    # parameters and turns args into the slots for a call's Frame: the
+    # args, then the rest args (if variadic) as a List, then UNSET for the
+    # body's def! targets. args must be a new list, which bind reuses.
+    padding = [UNSET] * (size - arity - variadic)
+    def mismatch(args):
+        expected = f"at least {arity}" if variadic else arity
+        return ArityError(
+            f"expected {expected} argument{'s' * (arity != 1)}, "
+            f"got {len(args)}"
+        )
+    if variadic:
+        def bind(args):
+            if len(args) < arity:
+                raise mismatch(args)
+            rest = List(args[arity:])
+            del args[arity:]
+            args.append(rest)
+            args += padding
+            return args
+    elif padding:
+        def bind(args):
+            if len(args) != arity:
+                raise mismatch(args)
+            args += padding
+            return args
+    else:
+        def bind(args):
+            if len(args) != arity:
+                raise mismatch(args)
+            return args
+    return bind
+
+
+def analyze_apply(ast: List, scope: Optional[Scope], tail: bool):
+    f_code, *arg_codes = [analyze(node, scope) for node in ast]
+    codes = [(code, getattr(code, "step", None)) for code in [f_code, *arg_codes]]
+    # The args list built for an Fn becomes the slots of its Frame, and
+    # builtins are passed their args directly. Calls with one or two args
+    # are spelled out so that builtins get them without any list at all.
+    match arg_codes:
+        case [a_code]:
+            def apply(env):
+                f = f_code(env)
+                if type(f) is Fn:
+                    env = Frame(f.env, f.bind([a_code(env)]))
+                    if tail:
+                        return TailCall(f.code, env)
+                    result = f.code(env)
+                    while type(result) is TailCall:
+                        result = result.code(result.env)
+                    return result
+                elif callable(f):
+                    return f(a_code(env))
+                a_code(env)
+                raise InvalidTypeError("attempted to call a non-function")
+        case [a_code, b_code]:
+            def apply(env):
+                f = f_code(env)
+                if type(f) is Fn:
+                    env = Frame(f.env, f.bind([a_code(env), b_code(env)]))
+                    if tail:
+                        return TailCall(f.code, env)
+                    result = f.code(env)
+                    while type(result) is TailCall:
+                        result = result.code(result.env)
+                    return result
+                elif callable(f):
+                    return f(a_code(env), b_code(env))
+                a_code(env)
+                b_code(env)
+                raise InvalidTypeError("attempted to call a non-function")
+        case _:
+            def apply(env):
+                f = f_code(env)
+                # A plain loop rather than a comprehension keeps non-tail
+                # recursion from spending an extra Python frame per Mal call.
+                args = []
+                for code in arg_codes:
+                    args.append(code(env))
+                if type(f) is Fn:
+                    env = Frame(f.env, f.bind(args))
+                    if tail:
+                        return TailCall(f.code, env)
+                    # run(), inlined for the same reason.
+                    result = f.code(env)
+                    while type(result) is TailCall:
+                        result = result.code(result.env)
+                    return result
+                elif callable(f):
+                    return f(*args)
+                else:
+                    raise InvalidTypeError("attempted to call a non-function")
+    def step(env):
+        # Leaves (symbols and constants, mostly) are evaluated in place
+        # rather than taking a round trip through run_stack().
+        args = []
+        for code, code_step in codes:
+            if code_step is None:
+                args.append(code(env))
+            else:
+                args.append((yield code, env))
+        f = args.pop(0)
+        if type(f) is Fn:
+            # The body replaces this step, whether or not the call is in
+            # tail position.
+            return TailCall(f.code, Frame(f.env, f.bind(args)))
+        elif callable(f):
+            return f(*args)
+        else:
+            raise InvalidTypeError("attempted to call a non-function")
+    apply.step = step
+    return apply
+
 
 def rep(x: str) -> str:
     r = READ(x)
@@ -116,14 +531,18 @@ def rep(x: str) -> str:
     return p
 
 
+evaluate = run_stack if os.environ.get("MAL_EVAL") == "stack" else run
+
 repl_env = Env()
 for k, v in core.ns.items():
     repl_env.set(Symbol(k), v)
 
 repl_env.set(Symbol("eval"), lambda ast: EVAL(ast, repl_env))
+repl_env.set(
+    Symbol("load-file"), lambda path: EVAL(formcache.read_file(path), repl_env)
+)
 
 rep(r'(def! not (fn* (a) (if a false true)))')
-rep(r'(def! load-file (fn* (f) (eval (read-string (str "(do " (slurp f) "\nnil)")))))')
 
 if len(sys.argv) > 1:
     _, script_path, *argv = sys.argv
@@ -157,6 +576,12 @@ while True:
     except InvalidTypeError as e:
         print(f"type error: {e}")
         continue
+    except ArityError as e:
+        print(f"arity error: {e}")
+        continue
+    except IndexOutOfRangeError as e:
+        print(f"index error: {e}")
+        continue
     except reader.EmptyExpression:
         continue
     print(p)
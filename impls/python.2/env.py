@@ -23,6 +23,9 @@ class Env(object):
                 else:
                     self.set(str(binds[x]), exprs[x])
 
+    def outer(self) -> Optional["Env"]:
+        return self._outer
+
     def set(self, key: str, value: MalExpression) -> MalExpression:
         self._data[key] = value
         return value
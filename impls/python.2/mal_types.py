@@ -168,11 +168,13 @@ class MalFunctionRaw(MalExpression):
         ast: MalExpression,
         params: MalList,
         env,
+        compiled=None,
     ) -> None:
         self._ast = ast
         self._params = params
         self._env = env
         self._native_function = fn
+        self._compiled = compiled
         self._is_macro = False
 
     def readable_str(self):
@@ -187,6 +189,10 @@ class MalFunctionRaw(MalExpression):
     def env(self):
         return self._env
 
+    def compiled(self):
+        """Return the compiled form of the function body, if any."""
+        return self._compiled
+
     def native(self) -> Callable[[List[MalExpression]], MalExpression]:
         return self._native_function
 
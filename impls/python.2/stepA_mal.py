@@ -1,7 +1,7 @@
 import functools
 import readline
 import sys
-from typing import List, Dict
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
 
 import core
 import reader
@@ -20,6 +20,7 @@ from mal_types import (
     MalUnknownSymbolException,
     MalInvalidArgumentException,
     MalString,
+    MalSyntaxException,
 )
 
 
@@ -27,21 +28,6 @@ def READ(x: str) -> MalExpression:
     return reader.read(x)
 
 
-def eval_ast(ast: MalExpression, env: Env) -> MalExpression:
-    if isinstance(ast, MalSymbol):
-        return env.get(ast)
-    if isinstance(ast, MalList):
-        return MalList([EVAL(x, env) for x in ast.native()])
-    if isinstance(ast, MalVector):
-        return MalVector([EVAL(x, env) for x in ast.native()])
-    if isinstance(ast, MalHash_map):
-        new_dict = {}  # type: Dict[str, MalExpression]
-        for key in ast.native():
-            new_dict[key] = EVAL(ast.native()[key], env)
-        return MalHash_map(new_dict)
-    return ast
-
-
 def qq_loop(acc: MalList, elt: MalExpression) -> MalList:
     if isinstance(elt, MalList):
         lst = elt.native()
@@ -71,120 +57,480 @@ def quasiquote(ast: MalExpression) -> MalExpression:
 
 
 def EVAL(ast: MalExpression, env: Env) -> MalExpression:
-    while True:
-        # print("EVAL: " + str(ast))
-        ast = macroexpand(ast, env)
-        ast_native = ast.native()
-        if not isinstance(ast, MalList):
-            return eval_ast(ast, env)
-        elif len(ast_native) == 0:
-            return ast
-
-        first_str = str(ast_native[0])
-        if first_str == "macroexpand":
-            return macroexpand(ast.native()[1], env)
-        elif first_str == "def!":
-            name: str = str(ast_native[1])
-            value: MalExpression = EVAL(ast_native[2], env)
-            return env.set(name, value)
-        if first_str == "defmacro!":
-            name = str(ast_native[1])
-            value = EVAL(ast_native[2], env)
-            assert isinstance(value, MalFunctionCompiled) or isinstance(
-                value, MalFunctionRaw
-            )
-            value.make_macro()
-            return env.set(name, value)
-        elif first_str == "let*":
-            assert len(ast_native) == 3
-            let_env = Env(env)
-            bindings: MalExpression = ast_native[1]
-            assert isinstance(bindings, MalList) or isinstance(bindings, MalVector)
-            bindings_list: List[MalExpression] = bindings.native()
-            assert len(bindings_list) % 2 == 0
-            for i in range(0, len(bindings_list), 2):
-                assert isinstance(bindings_list[i], MalSymbol)
-                assert isinstance(bindings_list[i + 1], MalExpression)
-                let_env.set(str(bindings_list[i]), EVAL(bindings_list[i + 1], let_env))
-            env = let_env
-            ast = ast_native[2]
-            continue
-        elif first_str == "do":
-            for x in range(1, len(ast_native) - 1):
-                EVAL(ast_native[x], env)
-            ast = ast_native[len(ast_native) - 1]
-            continue
-        elif first_str == "if":
-            condition = EVAL(ast_native[1], env)
-
-            if isinstance(condition, MalNil) or (
-                isinstance(condition, MalBoolean) and condition.native() is False
-            ):
-                if len(ast_native) >= 4:
-                    ast = ast_native[3]
-                    continue
-                else:
-                    return MalNil()
-            else:
-                ast = ast_native[2]
-                continue
-        elif first_str == "fn*":
-            raw_ast = ast_native[2]
-            raw_params = ast_native[1]
-
-            def fn(args: List[MalExpression]) -> MalExpression:
-                f_ast = raw_ast
-                f_env = Env(outer=env, binds=raw_params.native(), exprs=args)
-                return EVAL(f_ast, f_env)
-
-            return MalFunctionRaw(fn=fn, ast=raw_ast, params=raw_params, env=env)
-        elif first_str == "quote":
-            return (
-                MalList(ast_native[1].native())
-                if isinstance(ast_native[1], MalVector)
-                else ast_native[1]
-            )
-        elif first_str == "quasiquoteexpand":
-            return quasiquote(ast_native[1])
-        elif first_str == "quasiquote":
-            ast = quasiquote(ast_native[1])
-            continue
-        elif first_str == "try*":
+    return run(compile_toplevel(ast, env), env)
+
+
+# EVAL compiles each form to a flat list of (opcode, argument) instructions
+# once, then runs it on a small stack machine. A Mal function's body is
+# compiled when its fn* form is, and the resulting Code is shared by every
+# closure made from that form. Calls push a frame onto an explicit frame
+# stack instead of recursing in Python, TAIL_CALL replaces the current frame,
+# and try* pushes a handler that a MalException unwinds back to.
+#
+# Macros are expanded when a form is compiled, so redefining a macro does not
+# change code that was compiled with the old one. A macro that throws while
+# expanding is compiled to a RAISE of its exception, so that the error comes
+# when (and where, for try*) the call it expanded would have run.
+
+(
+    CONST,
+    LOAD,
+    DEF,
+    DEFMACRO,
+    POP,
+    JUMP,
+    JUMP_IF_FALSE,
+    LET,
+    BIND,
+    POP_ENV,
+    CLOSURE,
+    CALL,
+    TAIL_CALL,
+    RETURN,
+    VECTOR,
+    HASH_MAP,
+    TRY,
+    END_TRY,
+    CATCH,
+    LAZY,
+    MACROEXPAND,
+    RAISE,
+) = range(22)
+
+
+class Code(object):
+    def __init__(self, ops: List[Tuple[int, Any]]) -> None:
+        self.ops = ops
+
+
+class FnTemplate(object):
+    """A compiled fn* form: what each closure made from it has in common."""
+
+    def __init__(self, params: MalExpression, body: MalExpression, code: Code) -> None:
+        self.params = params
+        self.body = body
+        self.code = code
+        names = [str(x) for x in params.native()]
+        if "&" in names:
+            i = names.index("&")
+            self.fixed = names[:i]
+            self.rest: Optional[str] = names[i + 1]
+        else:
+            self.fixed = names
+            self.rest = None
+
+    def bind(self, outer: Env, args: List[MalExpression]) -> Env:
+        env = Env(outer)
+        for name, arg in zip(self.fixed, args):
+            env.set(name, arg)
+        if self.rest is not None:
+            env.set(self.rest, MalList(args[len(self.fixed) :]))
+        return env
+
+
+class LazyForm(object):
+    """A call whose head was unbound at compile time.
+
+    It may turn out to be a macro defined by the time the form first runs
+    (in the same do, or later in the same file), so compiling it waits
+    until then."""
+
+    def __init__(self, ast: MalExpression, local_names: FrozenSet[str]) -> None:
+        self.ast = ast
+        self.local_names = local_names
+        self.code: Optional[Code] = None
+
+
+class Compiler(object):
+    def __init__(self, env: Env, eager: Optional[MalExpression] = None) -> None:
+        # Only used to find macros to expand.
+        self.env = env
+        # A call that must be compiled now even if its head is unbound:
+        # the form a LazyForm is finally being compiled for.
+        self.eager = eager
+        self.ops: List[Tuple[int, Any]] = []
+
+    def emit(self, op: int, arg: Any = None) -> int:
+        self.ops.append((op, arg))
+        return len(self.ops) - 1
+
+    def patch(self, index: int, arg: Any) -> None:
+        self.ops[index] = (self.ops[index][0], arg)
+
+    def here(self) -> int:
+        return len(self.ops)
+
+    def macro(self, ast: MalExpression, local_names: FrozenSet[str]):
+        # The macro that ast is a call to, or None.
+        if not isinstance(ast, MalList) or not ast.native():
+            return None
+        head = ast.native()[0]
+        if not isinstance(head, MalSymbol) or head.native() in local_names:
+            return None
+        location = self.env.find(head)
+        if location is None:
+            return None
+        f = location.get(head)
+        if isinstance(f, (MalFunctionRaw, MalFunctionCompiled)) and f.is_macro():
+            return f
+        return None
+
+    def compile(
+        self, ast: MalExpression, local_names: FrozenSet[str], tail: bool
+    ) -> None:
+        # In tail position the emitted code ends by returning from the
+        # current frame; otherwise it leaves one value on the stack.
+        while (macro := self.macro(ast, local_names)) is not None:
             try:
-                return EVAL(ast_native[1], env)
+                ast = macro.call(ast.native()[1:])
             except MalException as e:
-                if len(ast_native) < 3:
-                    raise e
-                catch_block = ast_native[2]
-                assert (
-                    isinstance(catch_block, MalList)
-                    and isinstance(catch_block.native()[0], MalSymbol)
-                    and str(catch_block.native()[0]) == "catch*"
-                    and len(catch_block.native()) == 3
-                )
-                exception_symbol = catch_block.native()[1]
-                assert isinstance(exception_symbol, MalSymbol)
-                env = Env(env)
-                env.set(str(exception_symbol), e.native())
-                ast = catch_block.native()[2]
-                continue
+                self.emit(RAISE, e)
+                return
+        if isinstance(ast, MalSymbol):
+            self.emit(LOAD, ast.native())
+        elif isinstance(ast, MalVector):
+            for x in ast.native():
+                self.compile(x, local_names, False)
+            self.emit(VECTOR, len(ast.native()))
+        elif isinstance(ast, MalHash_map):
+            keys = list(ast.native())
+            for key in keys:
+                self.compile(ast.native()[key], local_names, False)
+            self.emit(HASH_MAP, keys)
+        elif not isinstance(ast, MalList) or not ast.native():
+            self.emit(CONST, ast)
         else:
-            evaled_ast = eval_ast(ast, env)
-            f = evaled_ast.native()[0]
-            args = evaled_ast.native()[1:]
-            if isinstance(f, MalFunctionRaw):
-                ast = f.ast()
-
-                env = Env(
-                    outer=f.env(),
-                    binds=f.params().native(),
-                    exprs=evaled_ast.native()[1:],
-                )
-                continue
-            elif isinstance(f, MalFunctionCompiled):
-                return f.call(args)
-            else:
-                raise MalInvalidArgumentException(f, "not a function")
+            head = ast.native()[0]
+            if isinstance(head, MalSymbol) and head.native() in special_forms:
+                special_forms[head.native()](self, ast.native(), local_names, tail)
+                return
+            self.compile_call(ast, local_names, tail)
+            return
+        if tail:
+            self.emit(RETURN)
+
+    def compile_call(
+        self, ast: MalList, local_names: FrozenSet[str], tail: bool
+    ) -> None:
+        head, *args = ast.native()
+        if (
+            isinstance(head, MalSymbol)
+            and ast is not self.eager
+            and head.native() not in local_names
+            and self.env.find(head) is None
+        ):
+            self.emit(LAZY, LazyForm(ast, local_names))
+            if tail:
+                self.emit(RETURN)
+            return
+        self.compile(head, local_names, False)
+        for x in args:
+            self.compile(x, local_names, False)
+        self.emit(TAIL_CALL if tail else CALL, len(args))
+
+
+def compile_def(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    name = str(ast[1])
+    # The name is about to be bound to a value, not a macro, so a recursive
+    # reference in the value need not wait for it to be defined.
+    c.compile(ast[2], local_names | {name}, False)
+    c.emit(DEF, name)
+    if tail:
+        c.emit(RETURN)
+
+
+def compile_defmacro(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    c.compile(ast[2], local_names, False)
+    c.emit(DEFMACRO, str(ast[1]))
+    if tail:
+        c.emit(RETURN)
+
+
+def compile_let(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    assert len(ast) == 3
+    bindings = ast[1]
+    assert isinstance(bindings, MalList) or isinstance(bindings, MalVector)
+    bindings_list: List[MalExpression] = bindings.native()
+    assert len(bindings_list) % 2 == 0
+    c.emit(LET)
+    for i in range(0, len(bindings_list), 2):
+        assert isinstance(bindings_list[i], MalSymbol)
+        c.compile(bindings_list[i + 1], local_names, False)
+        name = str(bindings_list[i])
+        c.emit(BIND, name)
+        local_names = local_names | {name}
+    c.compile(ast[2], local_names, tail)
+    if not tail:
+        c.emit(POP_ENV)
+
+
+def compile_do(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    if len(ast) == 1:
+        c.compile(MalNil(), local_names, tail)
+        return
+    for x in ast[1:-1]:
+        c.compile(x, local_names, False)
+        c.emit(POP)
+    c.compile(ast[-1], local_names, tail)
+
+
+def compile_if(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    c.compile(ast[1], local_names, False)
+    to_else = c.emit(JUMP_IF_FALSE)
+    c.compile(ast[2], local_names, tail)
+    to_end = None if tail else c.emit(JUMP)
+    c.patch(to_else, c.here())
+    c.compile(ast[3] if len(ast) >= 4 else MalNil(), local_names, tail)
+    if to_end is not None:
+        c.patch(to_end, c.here())
+
+
+def compile_fn(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    params, body = ast[1], ast[2]
+    body_compiler = Compiler(c.env)
+    names = frozenset(str(x) for x in params.native())
+    body_compiler.compile(body, local_names | names, True)
+    c.emit(CLOSURE, FnTemplate(params, body, Code(body_compiler.ops)))
+    if tail:
+        c.emit(RETURN)
+
+
+def compile_quote(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    value = MalList(ast[1].native()) if isinstance(ast[1], MalVector) else ast[1]
+    c.emit(CONST, value)
+    if tail:
+        c.emit(RETURN)
+
+
+def compile_quasiquote(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    c.compile(quasiquote(ast[1]), local_names, tail)
+
+
+def compile_quasiquoteexpand(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    c.emit(CONST, quasiquote(ast[1]))
+    if tail:
+        c.emit(RETURN)
+
+
+def compile_macroexpand(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    c.emit(CONST, ast[1])
+    c.emit(MACROEXPAND)
+    if tail:
+        c.emit(RETURN)
+
+
+def compile_try(
+    c: Compiler, ast: List[MalExpression], local_names: FrozenSet[str], tail: bool
+) -> None:
+    if len(ast) < 3:
+        c.compile(ast[1], local_names, tail)
+        return
+    catch_block = ast[2]
+    assert (
+        isinstance(catch_block, MalList)
+        and isinstance(catch_block.native()[0], MalSymbol)
+        and str(catch_block.native()[0]) == "catch*"
+        and len(catch_block.native()) == 3
+    )
+    exception_symbol = catch_block.native()[1]
+    assert isinstance(exception_symbol, MalSymbol)
+    to_handler = c.emit(TRY)
+    # The handler must stay in place until the body is done, so the body is
+    # never in tail position.
+    c.compile(ast[1], local_names, False)
+    c.emit(END_TRY)
+    to_end = c.emit(RETURN) if tail else c.emit(JUMP)
+    c.patch(to_handler, c.here())
+    name = str(exception_symbol)
+    c.emit(CATCH, name)
+    c.compile(catch_block.native()[2], local_names | {name}, tail)
+    if not tail:
+        c.emit(POP_ENV)
+        c.patch(to_end, c.here())
+
+
+special_forms = {
+    "def!": compile_def,
+    "defmacro!": compile_defmacro,
+    "let*": compile_let,
+    "do": compile_do,
+    "if": compile_if,
+    "fn*": compile_fn,
+    "quote": compile_quote,
+    "quasiquote": compile_quasiquote,
+    "quasiquoteexpand": compile_quasiquoteexpand,
+    "macroexpand": compile_macroexpand,
+    "try*": compile_try,
+}
+
+
+def compile_toplevel(ast: MalExpression, env: Env) -> Code:
+    c = Compiler(env)
+    forms = ast.native() if isinstance(ast, MalList) else []
+    if len(forms) > 1 and isinstance(forms[0], MalSymbol) and forms[0].native() == "do":
+        # Each form of a top-level do (a file being loaded) is compiled when
+        # it is reached, as if it had been entered on its own, so that it is
+        # expanded with the macros the forms before it have defined.
+        for x in forms[1:-1]:
+            c.emit(LAZY, LazyForm(x, frozenset()))
+            c.emit(POP)
+        c.emit(LAZY, LazyForm(forms[-1], frozenset()))
+        c.emit(RETURN)
+    else:
+        c.compile(ast, frozenset(), True)
+    return Code(c.ops)
+
+
+def compile_lazy(form: LazyForm, env: Env) -> Code:
+    c = Compiler(env, eager=form.ast)
+    c.compile(form.ast, form.local_names, True)
+    return Code(c.ops)
+
+
+def make_function(template: FnTemplate, env: Env) -> MalFunctionRaw:
+    def fn(args: List[MalExpression]) -> MalExpression:
+        return run(template.code, template.bind(env, args))
+
+    return MalFunctionRaw(
+        fn=fn, ast=template.body, params=template.params, env=env, compiled=template
+    )
+
+
+def run(code: Code, env: Env) -> MalExpression:
+    stack: List[Any] = []
+    # Callers' (ops, pc, env), and active try* handlers as
+    # (frame count, stack height, ops, handler pc, env).
+    frames: List[Tuple[List[Tuple[int, Any]], int, Env]] = []
+    handlers: List[Tuple[int, int, List[Tuple[int, Any]], int, Env]] = []
+    ops = code.ops
+    pc = 0
+    while True:
+        try:
+            while True:
+                op, arg = ops[pc]
+                pc += 1
+                if op == LOAD:
+                    stack.append(env.get(arg))
+                elif op == CONST:
+                    stack.append(arg)
+                elif op == CALL or op == TAIL_CALL:
+                    if arg:
+                        args = stack[-arg:]
+                        del stack[-arg:]
+                    else:
+                        args = []
+                    f = stack.pop()
+                    if isinstance(f, MalFunctionRaw):
+                        if op == CALL:
+                            frames.append((ops, pc, env))
+                        template = f.compiled()
+                        env = template.bind(f.env(), args)
+                        ops = template.code.ops
+                        pc = 0
+                        continue
+                    elif isinstance(f, MalFunctionCompiled):
+                        stack.append(f.call(args))
+                    else:
+                        raise MalInvalidArgumentException(f, "not a function")
+                    if op == TAIL_CALL:
+                        if not frames:
+                            return stack.pop()
+                        ops, pc, env = frames.pop()
+                elif op == RETURN:
+                    # The frame's result is already on top of the stack.
+                    if not frames:
+                        return stack.pop()
+                    ops, pc, env = frames.pop()
+                elif op == JUMP_IF_FALSE:
+                    condition = stack.pop()
+                    if isinstance(condition, MalNil) or (
+                        isinstance(condition, MalBoolean)
+                        and condition.native() is False
+                    ):
+                        pc = arg
+                elif op == JUMP:
+                    pc = arg
+                elif op == POP:
+                    stack.pop()
+                elif op == LET:
+                    env = Env(env)
+                elif op == BIND:
+                    env.set(arg, stack.pop())
+                elif op == POP_ENV:
+                    env = env.outer()
+                elif op == CLOSURE:
+                    stack.append(make_function(arg, env))
+                elif op == LAZY:
+                    if arg.code is None:
+                        arg.code = compile_lazy(arg, env)
+                    # Run the form's code as a frame of its own, sharing env.
+                    if ops[pc][0] != RETURN:
+                        frames.append((ops, pc, env))
+                    ops = arg.code.ops
+                    pc = 0
+                elif op == DEF:
+                    env.set(arg, stack[-1])
+                elif op == DEFMACRO:
+                    value = stack[-1]
+                    assert isinstance(value, MalFunctionCompiled) or isinstance(
+                        value, MalFunctionRaw
+                    )
+                    value.make_macro()
+                    env.set(arg, value)
+                elif op == VECTOR:
+                    if arg:
+                        values = stack[-arg:]
+                        del stack[-arg:]
+                    else:
+                        values = []
+                    stack.append(MalVector(values))
+                elif op == HASH_MAP:
+                    if arg:
+                        values = stack[-len(arg) :]
+                        del stack[-len(arg) :]
+                    else:
+                        values = []
+                    stack.append(MalHash_map(dict(zip(arg, values))))
+                elif op == TRY:
+                    handlers.append((len(frames), len(stack), ops, arg, env))
+                elif op == END_TRY:
+                    handlers.pop()
+                elif op == CATCH:
+                    env = Env(env)
+                    env.set(arg, stack.pop())
+                elif op == MACROEXPAND:
+                    stack[-1] = macroexpand(stack[-1], env)
+                elif op == RAISE:
+                    raise arg
+                else:
+                    raise MalSyntaxException("bad opcode " + str(op))
+        except MalException as e:
+            if not handlers:
+                raise
+            depth, height, ops, pc, env = handlers.pop()
+            del frames[depth:]
+            del stack[height:]
+            stack.append(e.native())
 
 
 def PRINT(x: MalExpression) -> str:
@@ -1,6 +1,7 @@
 import unittest
 
 import stepA_mal
+from mal_types import MalException, MalInt
 
 
 class TestStepA(unittest.TestCase):
@@ -62,6 +63,50 @@ class TestStepA(unittest.TestCase):
         )
         self.assertEqual("(1 2 3)", self.rep('(get @e "bar")'))
 
+    def test_deep_non_tail_recursion(self):
+        self.rep("(def! sumdown (fn* (n) (if (= n 0) 0 (+ n (sumdown (- n 1))))))")
+        self.assertEqual("12502500", self.rep("(sumdown 5000)"))
+
+    def test_compiled_code_kept_on_function(self):
+        self.rep("(def! f (fn* (a) (+ a 1)))")
+        self.rep("(def! g (fn* (a) (+ a 1)))")
+        f = self._repl_env.get("f")
+        self.assertIsNotNone(f.compiled())
+        self.assertIsNot(f.compiled(), self._repl_env.get("g").compiled())
+        self.rep("(def! make (fn* (x) (fn* () x)))")
+        self.assertIs(
+            self._repl_env.get("make").call([MalInt(1)]).compiled(),
+            self._repl_env.get("make").call([MalInt(2)]).compiled(),
+        )
+
+    def test_macro_defined_after_use(self):
+        self.rep("(def! f (fn* () (later 1)))")
+        self.rep("(defmacro! later (fn* (x) `(+ ~x 100)))")
+        self.assertEqual("101", self.rep("(f)"))
+
+    def test_try_catch_unwinds_frames(self):
+        self.rep("(def! g (fn* (n) (if (= n 0) (throw n) (+ 1 (g (- n 1))))))")
+        self.assertEqual("7", self.rep("(let* (x 7) (try* (g 50) (catch* e x)))"))
+
+    def test_try_catches_macro_error(self):
+        self.assertEqual(
+            '"odd number of forms to cond"', self.rep("(try* (cond 1) (catch* e e))")
+        )
+
+    def test_macro_error_thrown_when_call_runs(self):
+        self.rep('(defmacro! bad (fn* () (throw "bad macro")))')
+        self.rep("(def! f (fn* () (try* (bad) (catch* e e))))")
+        self.assertEqual('"bad macro"', self.rep("(f)"))
+
+    def test_toplevel_do_forms_compiled_in_turn(self):
+        self.rep('(defmacro! bad (fn* () (throw "bad macro")))')
+        with self.assertRaises(MalException):
+            self.rep("(do (def! a 1) (bad) (def! b 2))")
+        self.assertEqual("1", self.rep("a"))
+        self.assertEqual(
+            "4", self.rep("(do (defmacro! dbl (fn* (x) `(* 2 ~x))) (dbl 2))")
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,10 @@
-import copy, time
-from itertools import chain
+import copy, sys, threading, time
+from collections import OrderedDict
+from itertools import chain, count as count_from, islice
+try:
+    xrange
+except NameError:
+    xrange = range
 
 import mal_types as types
 from mal_types import MalException, List, Vector
@@ -55,34 +60,234 @@ def vals(hm): return types._list(*hm.values())
 # Sequence functions
 def coll_Q(coll): return sequential_Q(coll) or hash_map_Q(coll)
 
-def cons(x, seq): return List([x]) + List(seq)
+def cons(x, seq):
+    if types._lazy_seq_Q(seq):
+        return types.LazySeq(types._Chunk([x], lambda: types._seq_chunk(seq)))
+    return List([x]) + List(seq)
 
-def concat(*lsts): return List(chain(*lsts))
+def concat(*lsts):
+    if any(types._lazy_seq_Q(lst) for lst in lsts):
+        return types._lazy_seq(chain(*map(iter, lsts)))
+    return List(chain(*lsts))
 
 def nth(lst, idx):
+    if types._lazy_seq_Q(lst):
+        try: return lst.nth(idx)
+        except IndexError: throw("nth: index out of range")
     if idx < len(lst): return lst[idx]
     else: throw("nth: index out of range")
 
 def first(lst):
     if types._nil_Q(lst): return None
+    elif types._lazy_seq_Q(lst): return lst.first()
     else: return lst[0]
 
 def rest(lst):
     if types._nil_Q(lst): return List([])
+    elif types._lazy_seq_Q(lst): return lst.rest()
     else: return List(lst[1:])
 
-def empty_Q(lst): return len(lst) == 0
+def empty_Q(lst):
+    if types._lazy_seq_Q(lst): return lst.empty()
+    return len(lst) == 0
 
 def count(lst):
     if types._nil_Q(lst): return 0
     else: return len(lst)
 
-def apply(f, *args): return f(*(list(args[0:-1])+args[-1]))
-
-def mapf(f, lst): return List(map(f, lst))
+def apply(f, *args): return f(*(list(args[0:-1])+list(args[-1])))
+
+# Left out as the collection, to ask map, filter, ... for a transducer
+transducer = object()
+
+def mapf(f, lst=transducer):
+    if lst is transducer: return map_xf(f)
+    if types._lazy_seq_Q(lst):
+        return types._lazy_seq((f(x) for x in lst), lst.size)
+    return List(map(f, lst))
+
+def filter_(pred, lst=transducer):
+    if lst is transducer: return filter_xf(pred)
+    if types._lazy_seq_Q(lst):
+        return types._lazy_seq(x for x in lst if truthy(pred(x)))
+    return List([x for x in lst or () if truthy(pred(x))])
+
+def keep(f, lst=transducer):
+    if lst is transducer: return keep_xf(f)
+    if types._lazy_seq_Q(lst):
+        return types._lazy_seq(y for y in (f(x) for x in lst) if y is not None)
+    return List([y for y in (f(x) for x in lst or ()) if y is not None])
+
+# Lazy sequence functions
+def range_(*args):
+    if not args:
+        return types._lazy_seq(count_from(0))
+    r = xrange(*args)
+    return types._lazy_seq(r, len(r))
+
+def iterate(f, x):
+    def values(x):
+        while True:
+            yield x
+            x = f(x)
+    return types._lazy_seq(values(x))
+
+def take(n, lst=transducer):
+    if lst is transducer: return take_xf(n)
+    n = max(n, 0)
+    if types._lazy_seq_Q(lst):
+        size = None if lst.size is None else min(n, lst.size)
+        return types._lazy_seq(islice(lst, n), size)
+    return List(lst[:n]) if lst else List()
+
+def drop(n, lst=transducer):
+    if lst is transducer: return drop_xf(n)
+    n = max(n, 0)
+    if types._lazy_seq_Q(lst):
+        size = None if lst.size is None else max(lst.size - n, 0)
+        return types._lazy_seq(islice(lst, n, None), size)
+    return List(lst[n:]) if lst else List()
+
+def lazy_seq(f):
+    # f is only called, for the sequence it returns, when the lazy sequence
+    # is first used
+    return types.LazySeq(types._Chunk([], lambda: types._seq_chunk(f())))
+
+# Reducing functions
+# These walk the collection in one pass, stopping when the reducing
+# function returns a reduced value. Hash maps are walked as [key value]
+# entries.
+def truthy(x): return x is not None and x is not False
+
+def entries(coll):
+    if coll is None: return ()
+    if types._hash_map_Q(coll):
+        return (Vector([k, v]) for k, v in coll.items())
+    return coll
+
+def reduce_(f, *args):
+    if len(args) == 1:
+        it = iter(entries(args[0]))
+        for init in it: break
+        else: return f()
+    else:
+        init, coll = args
+        it = iter(entries(coll))
+    acc = init
+    for x in it:
+        acc = f(acc, x)
+        if type(acc) is types.Reduced: return acc.val
+    return acc
+
+def reduce_kv(f, init, coll):
+    if types._hash_map_Q(coll): kvs = coll.items()
+    else: kvs = enumerate(coll or ())
+    acc = init
+    for k, v in kvs:
+        acc = f(acc, k, v)
+        if type(acc) is types.Reduced: return acc.val
+    return acc
+
+# Transducers
+# A transducer turns a reducing function rf into another. Reducing
+# functions here take (acc x) to add an element and (acc) to complete the
+# result; transduce and into make a plain two-argument function complete by
+# returning acc as it is.
+def completing(f):
+    def rf(*args):
+        if len(args) == 1: return args[0]
+        return f(*args)
+    return rf
+
+def map_xf(f):
+    def xform(rf):
+        def step(acc, *x):
+            if not x: return rf(acc)
+            return rf(acc, f(x[0]))
+        return step
+    return xform
+
+def filter_xf(pred):
+    def xform(rf):
+        def step(acc, *x):
+            if not x: return rf(acc)
+            return rf(acc, x[0]) if truthy(pred(x[0])) else acc
+        return step
+    return xform
+
+def keep_xf(f):
+    def xform(rf):
+        def step(acc, *x):
+            if not x: return rf(acc)
+            y = f(x[0])
+            return acc if y is None else rf(acc, y)
+        return step
+    return xform
+
+def take_xf(n):
+    def xform(rf):
+        left = [n]
+        def step(acc, *x):
+            if not x: return rf(acc)
+            left[0] -= 1
+            if left[0] > 0: return rf(acc, x[0])
+            acc = rf(acc, x[0]) if left[0] == 0 else acc
+            return acc if type(acc) is types.Reduced else types.Reduced(acc)
+        return step
+    return xform
+
+def drop_xf(n):
+    def xform(rf):
+        left = [n]
+        def step(acc, *x):
+            if not x: return rf(acc)
+            if left[0] > 0:
+                left[0] -= 1
+                return acc
+            return rf(acc, x[0])
+        return step
+    return xform
+
+def comp(*fs):
+    if not fs: return lambda x: x
+    def composed(*args):
+        x = fs[-1](*args)
+        for f in reversed(fs[:-1]): x = f(x)
+        return x
+    return composed
+
+def transduce(xform, f, *args):
+    # Mal's reducing functions, + among them, have no 0-arity form to
+    # give an init value, so one is needed
+    if len(args) != 2: throw("transduce: needs an init value")
+    init, coll = args
+    rf = xform(completing(f))
+    acc = init
+    for x in entries(coll):
+        acc = rf(acc, x)
+        if type(acc) is types.Reduced:
+            acc = acc.val
+            break
+    return rf(acc)
+
+def into(to, *args):
+    if len(args) == 1:
+        items = list(entries(args[0]))
+    else:
+        xform, coll = args
+        items = transduce(xform, lambda acc, x: acc.append(x) or acc, [], coll)
+    if types._hash_map_Q(to):
+        hm = copy.copy(to)
+        for k, v in items: hm[k] = v
+        return hm
+    if to is None: to = List()
+    return conj(to, *items)
 
 # retains metadata
 def conj(lst, *args):
+    if types._lazy_seq_Q(lst):
+        for x in args: lst = cons(x, lst)
+        return lst
     if types._list_Q(lst): 
         new_lst = List(list(reversed(list(args))) + lst)
     else:
@@ -92,7 +297,9 @@ def conj(lst, *args):
     return new_lst
 
 def seq(obj):
-    if types._list_Q(obj):
+    if types._lazy_seq_Q(obj):
+        return None if obj.empty() else obj
+    elif types._list_Q(obj):
         return obj if len(obj) > 0 else None
     elif types._vector_Q(obj):
         return List(obj) if len(obj) > 0 else None
@@ -112,14 +319,164 @@ def meta(obj):
     return getattr(obj, "__meta__", None)
 
 
+# Memoization functions
+def hash_key(x):
+    # A hashable key for x, equal for values that are = (lists and vectors
+    # with equal elements, say) and different for ones that aren't (a
+    # symbol and a string, true and 1)
+    if types._sequential_Q(x):
+        return ('seq', tuple(hash_key(e) for e in x))
+    if types._hash_map_Q(x):
+        return ('map', frozenset((hash_key(k), hash_key(v))
+                                 for k, v in x.items()))
+    return (type(x), x)
+
+class Memo(object):
+    def __init__(self, f, max_size, ttl_ms):
+        self.f = f
+        self.max_size = max_size
+        self.ttl = None if ttl_ms is None else ttl_ms / 1000.0
+        self.cache = OrderedDict()  # key -> (value, expiry), oldest first
+        self.lock = types.allocate_lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, *args):
+        key = tuple(hash_key(a) for a in args)
+        with self.lock:
+            entry = self.cache.pop(key, None)
+            if entry is not None and (entry[1] is None or
+                                      entry[1] > time.time()):
+                self.cache[key] = entry  # now the most recently used
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # Not under the lock: f may call this (recursively, or in another
+        # thread) in the meantime
+        value = self.f(*args)
+        expiry = None if self.ttl is None else time.time() + self.ttl
+        with self.lock:
+            self.cache[key] = (value, expiry)
+            if self.max_size is not None:
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = types.allocate_lock()
+
+def memoize(f, opts=None):
+    opts = opts or {}
+    return Memo(f, opts.get(types._keyword('max-size')),
+                opts.get(types._keyword('ttl')))
+
+def memoize_stats(mf):
+    with mf.lock:
+        return types._hash_map(
+            types._keyword('hits'), mf.hits,
+            types._keyword('misses'), mf.misses,
+            types._keyword('evictions'), mf.evictions,
+            types._keyword('size'), len(mf.cache))
+
+def memoize_clear_BANG(mf):
+    with mf.lock:
+        mf.cache.clear()
+    return None
+
+
 # Atoms functions
-def deref(atm):    return atm.val
+def deref(ref, timeout_ms=None, timeout_val=None):
+    if types._future_Q(ref):
+        return future_result(ref, timeout_ms, timeout_val)
+    if types._ref_Q(ref):
+        import stm
+        return stm.deref(ref)
+    return ref.val
 def reset_BANG(atm,val):
-    atm.val = val
-    return atm.val
+    return atm.reset(val)
 def swap_BANG(atm,f,*args):
-    atm.val = f(atm.val,*args)
-    return atm.val
+    # f may be called more than once if other threads change atm meanwhile
+    while True:
+        old = atm.val
+        new = f(old,*args)
+        if atm.compare_and_set(old, new):
+            return new
+def compare_and_set_BANG(atm, old, new):
+    return atm.compare_and_set(old, new)
+
+# Futures functions
+# The thread pool (and concurrent.futures) are only set up when the first
+# future is made. Python 2 has no concurrent.futures, and there each future
+# gets a thread of its own.
+class FutureTimeout(Exception): pass
+
+class ThreadFuture(object):
+    # The part of a concurrent.futures future that Mal uses
+    def __init__(self, f):
+        self.finished = threading.Event()
+        self.value = self.error = None
+        thread = threading.Thread(target=self.run, args=(f,))
+        thread.daemon = True
+        thread.start()
+    def run(self, f):
+        try:
+            self.value = f()
+        except Exception as e:
+            self.error = e
+        self.finished.set()
+    def done(self):
+        return self.finished.is_set()
+    def result(self, timeout=None):
+        if not self.finished.wait(timeout):
+            raise FutureTimeout()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class ThreadExecutor(object):
+    def submit(self, f):
+        return ThreadFuture(f)
+
+executor = None
+timeout_error = FutureTimeout
+def future(f):
+    global executor, timeout_error
+    if executor is None:
+        try:
+            from concurrent.futures import ThreadPoolExecutor, TimeoutError
+            executor, timeout_error = ThreadPoolExecutor(), TimeoutError
+        except ImportError:
+            executor = ThreadExecutor()
+    return types.Future(executor.submit(f))
+def future_result(fut, timeout_ms=None, timeout_val=None):
+    if timeout_ms is None:
+        return fut.future.result()
+    try:
+        return fut.future.result(timeout_ms / 1000.0)
+    except timeout_error:
+        return timeout_val
+
+# Channels and refs functions
+# csp (with asyncio) and stm are only loaded when one of their functions is
+# first called
+def lazy_function(module, name):
+    def f(*args):
+        return getattr(__import__(module), name)(*args)
+    return f
+
+def csp_function(name):
+    # csp is written with async def, which Python 2 can't parse
+    if sys.version_info[0] >= 3:
+        return lazy_function('csp', name)
+    def f(*args):
+        throw("channels need Python 3")
+    return f
 
 
 ns = { 
@@ -180,15 +537,57 @@ ns = {
         'count': count,
         'apply': apply,
         'map': mapf,
+        'filter': filter_,
+        'keep': keep,
+        'reduce': reduce_,
+        'reduce-kv': reduce_kv,
+        'reduced': types._reduced,
+        'reduced?': types._reduced_Q,
+        'transduce': transduce,
+        'into': into,
+        'comp': comp,
+        'range': range_,
+        'iterate': iterate,
+        'take': take,
+        'drop': drop,
+        'lazy-seq': lazy_seq,
 
         'conj': conj,
         'seq': seq,
 
         'with-meta': with_meta,
         'meta': meta,
+        'memoize': memoize,
+        'memoize-stats': memoize_stats,
+        'memoize-clear!': memoize_clear_BANG,
+
         'atom': types._atom,
         'atom?': types._atom_Q,
         'deref': deref,
         'reset!': reset_BANG,
-        'swap!': swap_BANG}
+        'swap!': swap_BANG,
+        'compare-and-set!': compare_and_set_BANG,
+
+        'future': future,
+        'future?': types._future_Q,
+        'future-done?': lambda fut: fut.future.done(),
+
+        'chan': csp_function('chan'),
+        'chan?': csp_function('_chan_Q'),
+        '>!': csp_function('put'),
+        '<!': csp_function('take'),
+        'close!': csp_function('close'),
+        'go': csp_function('go'),
+        'timeout': csp_function('timeout'),
+        'slurp-async': csp_function('slurp_async'),
+        'readline-async': csp_function('readline_async'),
+        'sh-async': csp_function('sh_async'),
+
+        'ref': types._ref,
+        'ref?': types._ref_Q,
+        'dosync': lazy_function('stm', 'dosync'),
+        'ref-set': lazy_function('stm', 'ref_set'),
+        'alter': lazy_function('stm', 'alter'),
+        'commute': lazy_function('stm', 'commute'),
+        'ensure': lazy_function('stm', 'ensure')}
 
@@ -0,0 +1,215 @@
+# Channels and go blocks, in the manner of Clojure's core.async
+#
+# Channels live on an asyncio event loop running in a background thread,
+# which is started by the first channel made. Puts and takes are queued on
+# the loop, and the Mal thread that makes one waits until it completes:
+# EVAL is not a coroutine, so a go block can't be parked the way
+# core.async parks one, and instead runs on a thread of its own.
+#
+# The I/O functions (slurp-async, readline-async, sh-async) run on the loop
+# itself, file and terminal reads on its executor, so any number of them
+# can be in flight without a thread each. Each delivers its result on a
+# channel. An error in one, or in a go block, is delivered on the channel
+# too, and thrown by the take that gets it.
+
+import collections
+import threading
+
+import mal_types as types
+import mal_readline
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            import asyncio
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name='csp')
+            thread.daemon = True
+            thread.start()
+    return _loop
+
+def _sync(method, *args):
+    # Runs method(*args) on the loop, and waits for the loop future it
+    # returns.
+    import asyncio
+    async def wait():
+        return await method(*args)
+    return asyncio.run_coroutine_threadsafe(wait(), loop()).result()
+
+def _spawn(coro):
+    import asyncio
+    asyncio.run_coroutine_threadsafe(coro, loop())
+
+class _Failure(object):
+    # An exception delivered on a channel in place of a value
+    def __init__(self, exc):
+        self.exc = exc
+
+DROPPING = types._keyword('dropping')
+SLIDING = types._keyword('sliding')
+
+class Channel(object):
+    # All of these methods but close run on the loop. put and take return
+    # a loop future for the result.
+    def __init__(self, size, policy):
+        self.size = size
+        self.policy = policy
+        self.buffer = collections.deque()
+        self.puts = collections.deque()   # (future, value) waiting for room
+        self.takes = collections.deque()  # futures waiting for a value
+        self.closed = False
+
+    def put(self, value):
+        done = _loop.create_future()
+        if self.closed:
+            done.set_result(False)
+            return done
+        done.set_result(True)
+        while self.takes:
+            take = self.takes.popleft()
+            if not take.done():
+                take.set_result(value)
+                return done
+        if len(self.buffer) < self.size:
+            self.buffer.append(value)
+        elif self.policy == SLIDING:
+            self.buffer.popleft()
+            self.buffer.append(value)
+        elif self.policy != DROPPING:
+            done = _loop.create_future()
+            self.puts.append((done, value))
+        return done
+
+    def take(self):
+        done = _loop.create_future()
+        if self.buffer:
+            done.set_result(self.buffer.popleft())
+            # Make room for the first waiting put
+            while self.puts:
+                put, value = self.puts.popleft()
+                if not put.done():
+                    self.buffer.append(value)
+                    put.set_result(True)
+                    break
+            return done
+        while self.puts:
+            put, value = self.puts.popleft()
+            if not put.done():
+                put.set_result(True)
+                done.set_result(value)
+                return done
+        if self.closed:
+            done.set_result(None)
+        else:
+            self.takes.append(done)
+        return done
+
+    def _close(self):
+        # Puts waiting already can still be taken
+        self.closed = True
+        while self.takes:
+            take = self.takes.popleft()
+            if not take.done():
+                take.set_result(None)
+
+    def close(self):
+        _loop.call_soon_threadsafe(self._close)
+
+    def __str__(self):
+        return "#<channel>"
+
+def _chan_Q(exp): return type(exp) == Channel
+
+def chan(size=0, policy=None):
+    if policy not in (None, DROPPING, SLIDING):
+        raise Exception("chan: unknown buffer type %s" % policy)
+    if policy is not None and size < 1:
+        raise Exception("chan: dropping and sliding buffers need a size")
+    loop()
+    return Channel(size, policy)
+
+def put(ch, value):
+    if value is None:
+        raise Exception(">!: can't put nil on a channel")
+    return _sync(ch.put, value)
+
+def take(ch):
+    value = _sync(ch.take)
+    if type(value) is _Failure:
+        raise value.exc
+    return value
+
+def close(ch):
+    ch.close()
+    return None
+
+def _deliver(ch, f):
+    # Puts the result of f on ch, or the exception it raised, and closes ch
+    try:
+        value = f()
+    except Exception as e:
+        value = _Failure(e)
+    if value is not None:
+        _sync(ch.put, value)
+    ch.close()
+
+def go(f):
+    """Runs f in a thread of its own, and returns a channel that gets its
+    result."""
+    ch = chan(1)
+    thread = threading.Thread(target=_deliver, args=(ch, f))
+    thread.daemon = True
+    thread.start()
+    return ch
+
+def timeout(ms):
+    """Returns a channel that closes after ms milliseconds."""
+    ch = chan()
+    _loop.call_soon_threadsafe(_loop.call_later, ms / 1000.0, ch._close)
+    return ch
+
+async def _in_executor(ch, f):
+    try:
+        value = await _loop.run_in_executor(None, f)
+    except Exception as e:
+        value = _Failure(e)
+    if value is not None:
+        await ch.put(value)
+    ch._close()
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def slurp_async(path):
+    ch = chan(1)
+    _spawn(_in_executor(ch, lambda: _read(path)))
+    return ch
+
+def readline_async(prompt):
+    ch = chan(1)
+    _spawn(_in_executor(ch, lambda: mal_readline.readline(prompt)))
+    return ch
+
+async def _sh(ch, command):
+    import asyncio
+    try:
+        proc = await asyncio.create_subprocess_shell(
+            command, stdout=asyncio.subprocess.PIPE)
+        out, _ = await proc.communicate()
+        value = out.decode()
+    except Exception as e:
+        value = _Failure(e)
+    await ch.put(value)
+    ch._close()
+
+def sh_async(command):
+    """Runs command in a shell, and returns a channel that gets its
+    output."""
+    ch = chan(1)
+    _spawn(_sh(ch, command))
+    return ch
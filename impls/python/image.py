@@ -0,0 +1,106 @@
+# Saving and restoring an environment as an image file
+#
+# An image is a pickle of an Env and everything reachable from it. Builtins
+# (the core functions, eval, EVAL itself) are not pickled but saved by name,
+# and bound to the running interpreter's own builtins on restore. Mal
+# functions are closures made by mal_types._function, which pickle can't
+# handle, so they are saved as the contents of their closure cells plus
+# their attributes, and rebuilt from a fresh closure when restored.
+
+import io
+import pickle
+import sys
+import types as pytypes
+
+import mal_types as types
+
+MAGIC = b'mal-image-1\n'
+
+_function_code = types._function(None, None, None, None, None).__code__
+
+# Attributes that are rebuilt (__gen_env__) or are only a cache (the
+# transpiler's) rather than part of the function.
+_transient = ('__gen_env__', '__compiled__', '__calls__', '__heads__',
+              '__generation__')
+
+def _function_state(f):
+    cells = dict((name, cell.cell_contents) for name, cell
+                 in zip(f.__code__.co_freevars, f.__closure__))
+    attrs = dict((k, v) for k, v in f.__dict__.items() if k not in _transient)
+    return cells, attrs, '__gen_env__' in f.__dict__
+
+def _new_function():
+    return types._function(None, None, None, None, None)
+
+def _set_function_state(f, state):
+    cells, attrs, has_gen_env = state
+    for name, cell in zip(f.__code__.co_freevars, f.__closure__):
+        cell.cell_contents = cells[name]
+    gen_env = f.__gen_env__
+    f.__dict__.clear()
+    f.__dict__.update(attrs)
+    if has_gen_env:
+        f.__gen_env__ = gen_env
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file, builtins):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.builtin_names = dict((id(v), k) for k, v in builtins.items())
+
+    def persistent_id(self, obj):
+        return self.builtin_names.get(id(obj))
+
+    def reducer_override(self, obj):
+        if type(obj) is pytypes.FunctionType and obj.__code__ is _function_code:
+            # The state is set after the new function is memoized, so
+            # functions can refer (through their env) to themselves.
+            return (_new_function, (), _function_state(obj), None, None,
+                    _set_function_state)
+        return NotImplemented
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, builtins):
+        pickle.Unpickler.__init__(self, file)
+        self.builtins = builtins
+
+    def persistent_load(self, pid):
+        return self.builtins[pid]
+
+def _check_version():
+    if sys.version_info < (3, 8):
+        raise Exception("images need Python 3.8 or later")
+
+def save(path, env, builtins):
+    """Writes env to an image file at path. builtins maps names to the
+    objects saved by name rather than pickled."""
+    _check_version()
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        try:
+            _Pickler(f, builtins).dump(env)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise Exception("cannot save image: %s" % e)
+    return None
+
+def load(path, builtins):
+    """Returns the env saved in the image file at path, with its builtins
+    bound to the objects of the same names in builtins."""
+    _check_version()
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("'%s' is not a mal image" % path)
+        return _Unpickler(f, builtins).load()
+
+def dumps(obj, builtins):
+    """Returns obj pickled as an image would be, for passing Mal values
+    to another process."""
+    f = io.BytesIO()
+    try:
+        _Pickler(f, builtins).dump(obj)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        raise Exception("cannot serialize value: %s" % e)
+    return f.getvalue()
+
+def loads(data, builtins):
+    """The inverse of dumps."""
+    return _Unpickler(io.BytesIO(data), builtins).load()
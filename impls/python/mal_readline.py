@@ -1,4 +1,8 @@
-import os, sys, readline as pyreadline
+import os, sys
+
+# The readline module (and the history file) are only loaded on the first
+# call, so that running a script doesn't pay for them.
+pyreadline = None
 
 history_loaded = False
 histfile = os.path.expanduser("~/.mal-history")
@@ -8,9 +12,10 @@ else:
     rl = raw_input
 
 def readline(prompt="user> "):
-    global history_loaded
+    global history_loaded, pyreadline
     if not history_loaded:
         history_loaded = True
+        import readline as pyreadline
         try:
             with open(histfile, "r") as hf:
                 for line in hf.readlines():
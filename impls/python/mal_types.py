@@ -1,4 +1,5 @@
 import sys, copy, types as pytypes
+from itertools import islice
 
 # python 3.0 differences
 if sys.hexversion > 0x3000000:
@@ -9,6 +10,11 @@ else:
     _u = lambda x: codecs.unicode_escape_decode(x)[0]
     _s2u = lambda x: unicode(x)
 
+try:
+    from _thread import allocate_lock
+except ImportError:
+    from thread import allocate_lock
+
 if sys.version_info[0] >= 3:
     str_types = [str]
 else:
@@ -24,7 +30,8 @@ def _equal_Q(a, b):
         return False;
     if _symbol_Q(a):
         return a == b
-    elif _list_Q(a) or _vector_Q(a):
+    elif _sequential_Q(a):
+        if _lazy_seq_Q(a) or _lazy_seq_Q(b): a, b = list(a), list(b)
         if len(a) != len(b): return False
         for i in range(len(a)):
             if not _equal_Q(a[i], b[i]): return False
@@ -40,7 +47,7 @@ def _equal_Q(a, b):
     else:
         return a == b
 
-def _sequential_Q(seq): return _list_Q(seq) or _vector_Q(seq)
+def _sequential_Q(seq): return _list_Q(seq) or _vector_Q(seq) or _lazy_seq_Q(seq)
 
 def _clone(obj):
     #if type(obj) == type(lambda x:x):
@@ -98,6 +105,8 @@ def _function(Eval, Env, ast, env, params):
     fn.__meta__ = None
     fn.__ast__ = ast
     fn.__gen_env__ = lambda args: Env(env, params, args)
+    fn.__params__ = params
+    fn.__env__ = env
     return fn
 def _function_Q(f):
     return callable(f)
@@ -125,6 +134,90 @@ class Vector(list):
 def _vector(*vals): return Vector(vals)
 def _vector_Q(exp): return type(exp) == Vector
 
+# lazy sequences
+#
+# A lazy sequence is realized a chunk (of up to CHUNK elements, from an
+# iterator) at a time. Each chunk, once realized, links to the next, and
+# a LazySeq is a chunk and an offset into it, so rest shares the chunks
+# and a sequence that nothing holds the head of can be walked in constant
+# memory.
+CHUNK = 32
+
+class _Chunk(object):
+    __slots__ = ('items', '_next', '_pending')
+    def __init__(self, items, pending):
+        self.items = items
+        self._next = None
+        self._pending = pending  # returns the next chunk, or None
+    def next(self):
+        if self._pending is not None:
+            self._next = self._pending()
+            self._pending = None
+        return self._next
+
+def _iter_chunk(it):
+    items = list(islice(it, CHUNK))
+    if not items: return None
+    return _Chunk(items, lambda: _iter_chunk(it))
+
+def _seq_chunk(seq):
+    # The chunks of seq, which may be any sequence or nil. A lazy sequence
+    # is spliced in rather than iterated, so that sequences built by
+    # recursion through lazy-seq and cons don't nest iterators.
+    if seq is None: return None
+    if not _lazy_seq_Q(seq): return _iter_chunk(iter(seq))
+    chunk = seq._realize()
+    if chunk is None or seq.i == 0: return chunk
+    return _Chunk(chunk.items[seq.i:], chunk.next)
+
+class LazySeq(object):
+    __slots__ = ('chunk', 'i', 'size', '__meta__')
+    def __init__(self, chunk, i=0, size=None):
+        self.chunk = chunk
+        self.i = i
+        self.size = size  # if known without realizing it all
+    def _realize(self):
+        # Returns the chunk holding the first element, or None if empty
+        chunk, i = self.chunk, self.i
+        while chunk is not None and i >= len(chunk.items):
+            chunk, i = chunk.next(), 0
+        self.chunk, self.i = chunk, i
+        return chunk
+    def first(self):
+        chunk = self._realize()
+        return None if chunk is None else chunk.items[self.i]
+    def rest(self):
+        chunk = self._realize()
+        if chunk is None: return self
+        size = None if self.size is None else self.size - 1
+        return LazySeq(chunk, self.i + 1, size)
+    def empty(self): return self._realize() is None
+    def nth(self, n):
+        chunk = self._realize()
+        n += self.i
+        while chunk is not None:
+            if n < len(chunk.items): return chunk.items[n]
+            n -= len(chunk.items)
+            chunk = chunk.next()
+        raise IndexError(n)
+    def __iter__(self):
+        # Not a generator method, which would hold on to self, and so to
+        # every chunk realized while iterating.
+        return _iter_seq(self._realize(), self.i)
+    def __len__(self):
+        if self.size is None:
+            self.size = sum(1 for _ in self)
+        return self.size
+def _iter_seq(chunk, i):
+    while chunk is not None:
+        for x in islice(chunk.items, i, None): yield x
+        chunk, i = chunk.next(), 0
+def _lazy_seq(iterable, size=None):
+    # Nothing is taken from iterable until the sequence is first used
+    it = iter(iterable)
+    return LazySeq(_Chunk([], lambda: _iter_chunk(it)), 0, size)
+def _lazy_seq_Q(exp): return type(exp) == LazySeq
+
 # Hash maps
 class Hash_Map(dict): pass
 def _hash_map(*key_vals):
@@ -134,12 +227,60 @@ def _hash_map(*key_vals):
 def _hash_map_Q(exp): return type(exp) == Hash_Map
 
 # atoms
+_scalar_types = tuple(str_types) + (Symbol, int, float)
 class Atom(object):
     def __init__(self, val):
         self.val = val
+        self.lock = allocate_lock()
+    def compare_and_set(self, old, new):
+        # Collections are compared by identity, as in Clojure, but scalars
+        # by value, since the reader makes a new object for each one read.
+        with self.lock:
+            val = self.val
+            if val is not old and not (type(val) is type(old) and
+                                       type(old) in _scalar_types and
+                                       val == old):
+                return False
+            self.val = new
+            return True
+    def reset(self, val):
+        with self.lock:
+            self.val = val
+        return val
+    def __getstate__(self):
+        return (self.val,)
+    def __setstate__(self, state):
+        self.val, = state
+        self.lock = allocate_lock()
 def _atom(val): return Atom(val)
 def _atom_Q(exp):   return type(exp) == Atom
 
+# reduced: the result of a reduction that stops early
+class Reduced(object):
+    def __init__(self, val):
+        self.val = val
+def _reduced(val): return Reduced(val)
+def _reduced_Q(exp): return type(exp) == Reduced
+
+# refs: changed by stm transactions. history holds (version, value)
+# pairs, the latest last.
+class Ref(object):
+    def __init__(self, val):
+        self.history = ((0, val),)
+    def __getstate__(self):
+        # Versions only mean something in the process that wrote them
+        return (self.history[-1][1],)
+    def __setstate__(self, state):
+        self.history = ((0, state[0]),)
+def _ref(val): return Ref(val)
+def _ref_Q(exp): return type(exp) == Ref
+
+# futures: the result of a function run on another thread
+class Future(object):
+    def __init__(self, future):
+        self.future = future
+def _future_Q(exp): return type(exp) == Future
+
 def py_to_mal(obj):
         if type(obj) == list:   return List(obj)
         if type(obj) == tuple:  return List(obj)
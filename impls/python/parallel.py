@@ -0,0 +1,105 @@
+# pmap: mapping a function over a sequence with a pool of worker processes
+#
+# The workers are forked from the interpreter when pmap is called, so they
+# start out with everything the parent has: the function being mapped, the
+# environment it closes over and every definition made so far. Only the
+# elements and the results travel between processes, a chunk at a time.
+# They are pickled the way images are, so they can be any Mal value,
+# functions included, with builtins sent by name.
+#
+# Where fork is not available, or inside a worker (which can't have workers
+# of its own), pmap is a plain map.
+
+import os
+import sys
+
+import mal_types as types
+import image
+
+# The number of workers, if not the number of CPUs
+WORKERS_VAR = 'MAL_PMAP_WORKERS'
+
+# By default each worker gets this many chunks, so that a worker that is
+# given cheap elements can pick up another chunk while others are busy.
+CHUNKS_PER_WORKER = 4
+
+# (f, builtins) of the pmap call the workers were forked for
+_job = None
+_in_worker = False
+
+def workers():
+    n = os.environ.get(WORKERS_VAR)
+    if n:
+        return max(1, int(n))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        pass
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def _start_worker():
+    global _in_worker
+    _in_worker = True
+
+def _run_chunk(data):
+    f, builtins = _job
+    try:
+        result = ('ok', image.dumps([f(x) for x in image.loads(data, builtins)],
+                                    builtins))
+    except types.MalException as e:
+        result = ('throw', image.dumps(e.object, builtins))
+    except Exception as e:
+        result = ('error', "%s: %s" % (type(e).__name__, e))
+    # Workers leave with os._exit, which doesn't flush
+    sys.stdout.flush()
+    return result
+
+def _fork_context():
+    try:
+        import multiprocessing
+        return multiprocessing.get_context('fork')
+    except (ImportError, AttributeError, ValueError):
+        return None
+
+def pmap(f, seq, builtins, chunk_size=None):
+    """Returns the list of f applied to each element of seq, computed by a
+    pool of worker processes. Elements are sent to the workers chunk_size
+    at a time."""
+    global _job
+    items = list(seq)
+    if chunk_size is not None and chunk_size < 1:
+        raise Exception("pmap: chunk size must be positive")
+    n = min(workers(), len(items))
+    context = None if _in_worker or n < 2 else _fork_context()
+    if context is None:
+        return types.List(map(f, items))
+    if chunk_size is None:
+        chunk_size = -(-len(items) // (n * CHUNKS_PER_WORKER))
+    chunks = [image.dumps(items[i:i + chunk_size], builtins)
+              for i in range(0, len(items), chunk_size)]
+    n = min(n, len(chunks))
+
+    # Anything left in the buffer would be written again by each worker
+    sys.stdout.flush()
+    _job = (f, builtins)
+    try:
+        pool = context.Pool(n, _start_worker)
+        try:
+            results = pool.map(_run_chunk, chunks, 1)
+        finally:
+            pool.terminate()
+    finally:
+        _job = None
+
+    out = []
+    for status, value in results:
+        if status == 'throw':
+            raise types.MalException(image.loads(value, builtins))
+        if status == 'error':
+            raise Exception(value)
+        out.extend(image.loads(value, builtins))
+    return types.List(out)
@@ -5,7 +5,7 @@ def _escape(s):
 
 def _pr_str(obj, print_readably=True):
     _r = print_readably
-    if types._list_Q(obj):
+    if types._list_Q(obj) or types._lazy_seq_Q(obj):
         return "(" + " ".join(map(lambda e: _pr_str(e,_r), obj)) + ")"
     elif types._vector_Q(obj):                                    
         return "[" + " ".join(map(lambda e: _pr_str(e,_r), obj)) + "]"
@@ -29,6 +29,10 @@ def _pr_str(obj, print_readably=True):
         return "false"
     elif types._atom_Q(obj):
         return "(atom " + _pr_str(obj.val,_r) + ")"
+    elif types._ref_Q(obj):
+        return "(ref " + _pr_str(obj.history[-1][1],_r) + ")"
+    elif types._future_Q(obj):
+        return "#<future " + ("done" if obj.future.done() else "pending") + ">"
     else:
         return obj.__str__()
 
@@ -1,10 +1,14 @@
+import sys, time
+clock = getattr(time, 'perf_counter', time.time)
+startup = [('start', clock(), len(sys.modules))]
+
 import functools
-import sys, traceback
 import mal_readline
 import mal_types as types
 import reader, printer
 from env import Env
 import core
+startup.append(('imports', clock(), len(sys.modules)))
 
 # read
 def READ(str):
@@ -73,6 +77,7 @@ def EVAL(ast, env):
         if "def!" == a0:
             a1, a2 = ast[1], ast[2]
             res = EVAL(a2, env)
+            if jit is not None: jit.rebound(a1)
             return env.set(a1, res)
         elif "let*" == a0:
             a1, a2 = ast[1], ast[2]
@@ -92,6 +97,7 @@ def EVAL(ast, env):
         elif 'defmacro!' == a0:
             func = types._clone(EVAL(ast[2], env))
             func._ismacro_ = True
+            if jit is not None: jit.rebound(ast[1])
             return env.set(ast[1], func)
         elif 'macroexpand' == a0:
             return macroexpand(ast[1], env)
@@ -140,11 +146,42 @@ def EVAL(ast, env):
             el = eval_ast(ast, env)
             f = el[0]
             if hasattr(f, '__ast__'):
-                ast = f.__ast__
-                env = f.__gen_env__(el[1:])
+                if compiled(f):
+                    # Nothing here may keep the arguments (the head of a
+                    # lazy sequence, say) alive while f runs
+                    del el[0]
+                    env = None
+                    result = jit.run(f, el)
+                    if type(result) is not transpiler.TailCall:
+                        return result
+                    # A tail call of a function that isn't compiled
+                    ast = result.f.__ast__
+                    env = result.f.__gen_env__(types.List(result.args))
+                    result = None
+                else:
+                    ast = f.__ast__
+                    env = f.__gen_env__(el[1:])
             else:
                 return f(*el[1:])
 
+# A function is compiled once it has been called HOT_CALLS times. The
+# transpiler is only imported when the first one gets hot, so that short
+# scripts don't load it, and is then given count_call to count calls with.
+HOT_CALLS = 10
+def count_call(f):
+    calls = f.__calls__ = getattr(f, '__calls__', 0) + 1
+    return calls
+
+jit = None
+def compiled(f):
+    global jit, transpiler
+    if jit is None:
+        if count_call(f) < HOT_CALLS:
+            return None
+        import transpiler
+        jit = transpiler.Transpiler(EVAL, quasiquote, count_call, HOT_CALLS)
+    return jit.compiled(f)
+
 # print
 def PRINT(exp):
     return printer._pr_str(exp)
@@ -154,22 +191,64 @@ repl_env = Env()
 def REP(str):
     return PRINT(EVAL(READ(str), repl_env))
 
+def save_image(path):
+    # image (and pickle) are only loaded when an image is used
+    import image
+    return image.save(path, repl_env, image_builtins)
+
+def pmap(f, seq, chunk_size=None):
+    import parallel
+    return parallel.pmap(f, seq, image_builtins, chunk_size)
+
+def print_startup_profile():
+    out = sys.stderr
+    out.write("startup profile:\n")
+    for (_, t0, m0), (phase, t1, m1) in zip(startup, startup[1:]):
+        out.write("  %-16s %7.2f ms  %3d modules\n"
+                  % (phase, (t1 - t0) * 1000, m1 - m0))
+    out.write("  %-16s %7.2f ms  %3d modules\n"
+              % ('total', (startup[-1][1] - startup[0][1]) * 1000,
+                 len(sys.modules)))
+
+startup_profile = len(sys.argv) >= 2 and sys.argv[1] == '--startup-profile'
+if startup_profile:
+    del sys.argv[1]
+
 # core.py: defined using python
 for k, v in core.ns.items(): repl_env.set(types._symbol(k), v)
 repl_env.set(types._symbol('eval'), lambda ast: EVAL(ast, repl_env))
+repl_env.set(types._symbol('save-image'), save_image)
+repl_env.set(types._symbol('pmap'), pmap)
+
+# Saved by name in images, and restored as this interpreter's own
+image_builtins = dict((str(k), v) for k, v in repl_env.data.items())
+image_builtins['EVAL'] = EVAL
+startup.append(('core namespace', clock(), len(sys.modules)))
+
+if len(sys.argv) >= 3 and sys.argv[1] == '--image':
+    # An image has the rest of the environment already
+    import image
+    repl_env = image.load(sys.argv[2], image_builtins)
+    del sys.argv[1:3]
+    startup.append(('image', clock(), len(sys.modules)))
+else:
+    # core.mal: defined using the language itself
+    REP("(def! *host-language* \"python\")")
+    REP("(def! not (fn* (a) (if a false true)))")
+    REP("(def! load-file (fn* (f) (eval (read-string (str \"(do \" (slurp f) \"\nnil)\")))))")
+    REP("(defmacro! cond (fn* (& xs) (if (> (count xs) 0) (list 'if (first xs) (if (> (count xs) 1) (nth xs 1) (throw \"odd number of forms to cond\")) (cons 'cond (rest (rest xs)))))))")
+    startup.append(('prelude', clock(), len(sys.modules)))
 repl_env.set(types._symbol('*ARGV*'), types._list(*sys.argv[2:]))
 
-# core.mal: defined using the language itself
-REP("(def! *host-language* \"python\")")
-REP("(def! not (fn* (a) (if a false true)))")
-REP("(def! load-file (fn* (f) (eval (read-string (str \"(do \" (slurp f) \"\nnil)\")))))")
-REP("(defmacro! cond (fn* (& xs) (if (> (count xs) 0) (list 'if (first xs) (if (> (count xs) 1) (nth xs 1) (throw \"odd number of forms to cond\")) (cons 'cond (rest (rest xs)))))))")
+if startup_profile:
+    print_startup_profile()
 
 if len(sys.argv) >= 2:
     REP('(load-file "' + sys.argv[1] + '")')
     sys.exit(0)
 
 # repl loop
+import traceback
 REP("(println (str \"Mal [\" *host-language* \"]\"))")
 while True:
     try:
@@ -0,0 +1,126 @@
+# Software transactional memory: refs changed in dosync transactions
+#
+# Each ref keeps its last few committed values, tagged with the version (a
+# global counter) of the commit that wrote them. A transaction reads every
+# ref as of the version current when it started, and keeps the values it
+# writes to itself until it commits. Committing checks that no ref it set,
+# altered or ensured has been written by another commit since it started,
+# and if one has, runs the transaction again from the start. Commuted refs
+# are not checked: their functions are applied again, to the latest
+# values, at commit.
+#
+# Only the commit itself (the check and the writes) holds the global lock,
+# so transactions run concurrently, and ones over disjoint refs never
+# retry because of each other.
+
+import threading
+
+# Committed values kept per ref, for transactions that started earlier
+HISTORY = 8
+MAX_RETRIES = 10000
+
+_commit_lock = threading.Lock()
+_version = 0
+_current = threading.local()
+
+# A BaseException, so that try* in the transaction doesn't catch it
+class _Retry(BaseException): pass
+
+class Transaction(object):
+    def __init__(self):
+        self.read_point = _version
+        self.values = {}    # ref -> its value in this transaction
+        self.sets = set()   # refs set or altered
+        self.ensures = set()
+        self.commutes = {}  # ref -> [(f, args)] to apply again at commit
+
+    def read(self, ref):
+        if ref in self.values:
+            return self.values[ref]
+        for version, value in reversed(ref.history):
+            if version <= self.read_point:
+                return value
+        # Every value old enough has been dropped from the history
+        raise _Retry()
+
+    def set(self, ref, value):
+        if ref in self.commutes and ref not in self.sets:
+            raise Exception("can't set a ref after commute")
+        self.sets.add(ref)
+        self.values[ref] = value
+        return value
+
+    def commute(self, ref, f, args):
+        value = f(self.read(ref), *args)
+        self.values[ref] = value
+        self.commutes.setdefault(ref, []).append((f, args))
+        return value
+
+    def commit(self):
+        global _version
+        with _commit_lock:
+            for ref in self.sets | self.ensures:
+                if ref.history[-1][0] > self.read_point:
+                    raise _Retry()
+            # Every value is worked out before any is written, so that a
+            # commute function that throws leaves nothing committed.
+            values = dict((ref, self.values[ref]) for ref in self.sets)
+            for ref, fns in self.commutes.items():
+                if ref not in self.sets:
+                    value = ref.history[-1][1]
+                    for f, args in fns:
+                        value = f(value, *args)
+                    values[ref] = value
+            version = _version + 1
+            for ref, value in values.items():
+                _write(ref, version, value)
+            _version = version
+
+def _write(ref, version, value):
+    # The history is replaced rather than changed, so that a transaction
+    # reading it concurrently sees either the old one or the new one.
+    ref.history = (ref.history + ((version, value),))[-HISTORY:]
+
+def _transaction(name):
+    tx = getattr(_current, 'tx', None)
+    if tx is None:
+        raise Exception("%s: no transaction running" % name)
+    return tx
+
+def dosync(f):
+    """Calls f in a transaction, and returns its result. A dosync in a
+    running transaction joins it."""
+    if getattr(_current, 'tx', None) is not None:
+        return f()
+    for _ in range(MAX_RETRIES):
+        _current.tx = tx = Transaction()
+        try:
+            result = f()
+            tx.commit()
+            return result
+        except _Retry:
+            continue
+        finally:
+            _current.tx = None
+    raise Exception("dosync: transaction retried %d times" % MAX_RETRIES)
+
+def deref(ref):
+    tx = getattr(_current, 'tx', None)
+    if tx is None:
+        return ref.history[-1][1]
+    return tx.read(ref)
+
+def ref_set(ref, value):
+    return _transaction('ref-set').set(ref, value)
+
+def alter(ref, f, *args):
+    tx = _transaction('alter')
+    return tx.set(ref, f(tx.read(ref), *args))
+
+def commute(ref, f, *args):
+    return _transaction('commute').commute(ref, f, args)
+
+def ensure(ref):
+    tx = _transaction('ensure')
+    tx.ensures.add(ref)
+    return tx.read(ref)
@@ -0,0 +1,530 @@
+# Translation of hot Mal functions into Python functions
+#
+# A Mal function starts out interpreted by EVAL. Once it has been called
+# hot_calls times (stepA's HOT_CALLS) its body is macroexpanded, translated
+# into a Python ast and compiled, and from then on it is called as a Python
+# function. Parameters and let* bindings become Python locals, if/do/let*
+# become Python control flow and a tail call of a function to itself becomes a
+# jump back to the top of its loop. Other tail calls return a TailCall for the
+# caller to run, so that tail recursion still runs in constant stack; one of a
+# function that is still interpreted goes back to EVAL's loop. Forms the
+# translator does not handle (try*, interop, ...) are handed to EVAL with an
+# Env holding the locals in scope.
+#
+# Compiled code is cached by the structure of the fn* form it came from, so
+# every closure made from the same fn* form shares a single code object. The
+# cache also records which symbols at the head of a form were macros, and
+# code is only shared between closures whose envs agree on those.
+#
+# The ast module is only imported once the first function gets hot, so
+# short scripts don't pay for loading it.
+
+import sys
+
+import mal_types as types
+from env import Env
+import core
+
+# Core functions called with two arguments are inlined as Python operators,
+# guarded by a check that the symbol is still bound to the core function.
+# The values are names of ast node classes.
+binary_ops = {'+': 'Add', '-': 'Sub', '*': 'Mult'}
+compare_ops = {'<': 'Lt', '<=': 'LtE', '>': 'Gt', '>=': 'GtE'}
+
+pyast = None
+
+# Forms left to EVAL. def! and defmacro! would bind names in an Env that the
+# compiled code never looks at, so a function using them is not compiled.
+eval_forms = ('try*', 'py!*', 'py*', '.', 'macroexpand', 'quasiquoteexpand')
+binding_forms = ('def!', 'defmacro!')
+
+class Unsupported(Exception): pass
+
+# Raised when the Env for an EVAL fallback or a closure is needed in the
+# middle of a let* binding list, where it could not see the later bindings.
+class NeedsEnv(Exception): pass
+
+class TailCall():
+    __slots__ = ('f', 'args')
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+
+def _tail(f, args):
+    if hasattr(f, '__ast__'):
+        return TailCall(f, args)
+    return f(*args)
+
+def _call_consuming(code, args):
+    # Pops the arguments as they are passed, for apply. A call of a Python
+    # function moves its arguments into the new frame, so once args is
+    # empty the callee holds the only references to them.
+    n = len(args)
+    args.reverse()
+    if n == 0:
+        return code()
+    if n == 1:
+        return code(args.pop())
+    if n == 2:
+        return code(args.pop(), args.pop())
+    if n == 3:
+        return code(args.pop(), args.pop(), args.pop())
+    args.reverse()
+    return code(*args)
+
+# ast construction helpers
+def _load(name): return pyast.Name(id=name, ctx=pyast.Load())
+def _store(name): return pyast.Name(id=name, ctx=pyast.Store())
+def _const(value): return pyast.Constant(value=value)
+def _call(f, *args): return pyast.Call(func=f, args=list(args), keywords=[])
+def _tuple(elts): return pyast.Tuple(elts=list(elts), ctx=pyast.Load())
+def _list(elts): return pyast.List(elts=list(elts), ctx=pyast.Load())
+def _index(value, i):
+    return pyast.Subscript(value=value, slice=i, ctx=pyast.Load())
+def _assign(name, value):
+    return pyast.Assign(targets=[_store(name)], value=value)
+def _is(a, b): return pyast.Compare(left=a, ops=[pyast.Is()], comparators=[b])
+def _is_not(a, b):
+    return pyast.Compare(left=a, ops=[pyast.IsNot()], comparators=[b])
+
+def _seq(exprs):
+    # Evaluates exprs in order for the value of the last one.
+    if len(exprs) == 1: return exprs[0]
+    return _index(_tuple(exprs), _const(-1))
+
+def _mentions(form, names):
+    if types._symbol_Q(form): return form in names
+    if types._list_Q(form) or types._vector_Q(form):
+        return any(_mentions(x, names) for x in form)
+    if types._hash_map_Q(form):
+        return any(_mentions(x, names) for x in form.values())
+    return False
+
+def _key(form):
+    if types._list_Q(form) or types._vector_Q(form):
+        return (type(form), tuple(_key(x) for x in form))
+    if types._hash_map_Q(form):
+        return (type(form), tuple((_key(k), _key(v)) for k, v in form.items()))
+    return (type(form), form)
+
+def _split_params(params):
+    # Returns the fixed parameters and the rest parameter (or None).
+    names = list(params)
+    if not all(types._symbol_Q(p) for p in names):
+        raise Unsupported()
+    if '&' not in names:
+        return names, None
+    i = names.index('&')
+    if len(names) != i + 2:
+        raise Unsupported()
+    return names[:i], names[i+1]
+
+def _macro(env, name):
+    # The macro name is bound to in env, or None
+    if env.find(name):
+        value = env.get(name)
+        if hasattr(value, '_ismacro_'):
+            return value
+    return None
+
+def _expanded_alike(env, heads):
+    # Whether each name in heads is the same macro (or not a macro) in env
+    for name, macro in heads.items():
+        if _macro(env, name) is not macro:
+            return False
+    return True
+
+class Function():
+    """Translates one fn* form into a Python factory of closures."""
+
+    def __init__(self, transpiler, env):
+        self.transpiler = transpiler
+        self.env = env  # for macroexpansion
+        # What each symbol at the head of a form looked up to, if a macro,
+        # or None: the decisions the code depends on besides the form.
+        self.heads = {}
+        self.consts = []
+        self.count = 0
+        self.binding = 0  # depth of let* binding lists being translated
+
+    def const(self, value):
+        self.consts.append(value)
+        return _index(_load('_k'), _const(len(self.consts) - 1))
+
+    def temp(self):
+        self.count += 1
+        return '_t%d' % self.count
+
+    def local(self):
+        self.count += 1
+        return '_v%d' % self.count
+
+    def literal(self, value):
+        if value is None or type(value) in (bool, int, str):
+            return _const(value)
+        return self.const(value)
+
+    def scope_env(self, scope):
+        if self.binding:
+            raise NeedsEnv()
+        if not scope:
+            return _load('_env')
+        names = list(scope)
+        return _call(_load('_Env'), _load('_env'), self.const(names),
+                     _tuple(_load(scope[n]) for n in names))
+
+    def fallback(self, form, scope):
+        if _mentions(form, binding_forms):
+            raise Unsupported()
+        return _call(_load('_EVAL'), self.const(form), self.scope_env(scope))
+
+    def expand(self, form, scope):
+        while (types._list_Q(form) and len(form) > 0 and
+               types._symbol_Q(form[0]) and form[0] not in scope):
+            macro = _macro(self.env, form[0])
+            self.heads[form[0]] = macro
+            if macro is None:
+                break
+            form = macro(*form[1:])
+        return form
+
+    def special(self, form, scope):
+        # Returns the name of the special form that form is, if the
+        # translator handles it, or None for a call. Forms left to EVAL
+        # raise NeedsEnv, for the caller to fall back on.
+        a0 = form[0]
+        if not types._symbol_Q(a0):
+            return None
+        if a0 in binding_forms:
+            raise Unsupported()
+        if a0 in eval_forms:
+            raise NeedsEnv()
+        n = len(form)
+        if ((a0 == 'if' and n in (3, 4)) or (a0 == 'do' and n >= 2) or
+            (a0 == 'quote' and n >= 2) or (a0 == 'quasiquote' and n >= 2) or
+            (a0 == 'fn*' and n >= 3)):
+            return a0
+        if a0 == 'let*' and n >= 3:
+            bindings = form[1]
+            if ((types._list_Q(bindings) or types._vector_Q(bindings)) and
+                len(bindings) % 2 == 0 and
+                all(types._symbol_Q(b) for b in bindings[::2])):
+                return a0
+            raise NeedsEnv()
+        if a0 in ('if', 'do', 'quote', 'quasiquote', 'fn*', 'let*'):
+            raise NeedsEnv()
+        return None
+
+    def let_bindings(self, form, scope):
+        # Returns the assignments of a let* and the scope of its body.
+        bindings = form[1]
+        inner = dict(scope)
+        values = []
+        self.binding += 1
+        try:
+            for i in range(0, len(bindings), 2):
+                value = self.expr(bindings[i+1], inner)
+                inner[bindings[i]] = self.local()
+                values.append((inner[bindings[i]], value))
+        finally:
+            self.binding -= 1
+        return values, inner
+
+    def expr(self, form, scope):
+        if types._symbol_Q(form):
+            if form in scope:
+                return _load(scope[form])
+            return _call(_load('_get'), self.const(form))
+        elif types._vector_Q(form):
+            return _call(_load('_vector'),
+                         *[self.expr(x, scope) for x in form])
+        elif types._hash_map_Q(form):
+            return _call(_load('_Hash_Map'), _tuple(
+                _tuple([self.literal(k), self.expr(v, scope)])
+                for k, v in form.items()))
+        elif not types._list_Q(form):
+            return self.literal(form)
+
+        try:
+            form = self.expand(form, scope)
+        except Exception:
+            return self.fallback(form, scope)
+        if not types._list_Q(form):
+            return self.expr(form, scope)
+        if len(form) == 0:
+            return self.const(form)
+        try:
+            a0 = self.special(form, scope)
+            if a0 == 'if':
+                test = self.truthy(self.expr(form[1], scope))
+                return pyast.IfExp(
+                    test=test, body=self.expr(form[2], scope),
+                    orelse=self.expr(form[3], scope) if len(form) > 3
+                           else _const(None))
+            elif a0 == 'do':
+                return _seq([self.expr(x, scope) for x in form[1:]])
+            elif a0 == 'let*':
+                values, inner = self.let_bindings(form, scope)
+                return _seq([pyast.NamedExpr(target=_store(name), value=v)
+                             for name, v in values] +
+                            [self.expr(form[2], inner)])
+            elif a0 == 'quote':
+                return self.literal(form[1])
+            elif a0 == 'quasiquote':
+                return self.expr(self.transpiler.quasiquote(form[1]), scope)
+            elif a0 == 'fn*':
+                return _call(_load('_function'), _load('_EVAL'),
+                             _load('_Env'), self.const(form[2]),
+                             self.scope_env(scope), self.const(form[1]))
+        except NeedsEnv:
+            return self.fallback(form, scope)
+        return self.call(form, scope)
+
+    def truthy(self, test):
+        t = self.temp()
+        return pyast.BoolOp(op=pyast.And(), values=[
+            _is_not(pyast.NamedExpr(target=_store(t), value=test),
+                    _const(None)),
+            _is_not(_load(t), _const(False))])
+
+    def call(self, form, scope):
+        a0 = form[0]
+        args = [self.expr(x, scope) for x in form[1:]]
+        if (len(args) == 2 and types._symbol_Q(a0) and a0 not in scope and
+            (a0 in binary_ops or a0 in compare_ops) and
+            self.env.find(a0) and self.env.get(a0) is core.ns[a0]):
+            # (a0 x y) as x OP y while a0 is still the core function.
+            if a0 in binary_ops:
+                op = getattr(pyast, binary_ops[a0])
+                inline = pyast.BinOp(left=args[0], op=op(), right=args[1])
+            else:
+                op = getattr(pyast, compare_ops[a0])
+                inline = pyast.Compare(left=args[0], ops=[op()],
+                                       comparators=[args[1]])
+            f = self.expr(a0, scope)
+            return pyast.IfExp(
+                test=_is(f, self.const(core.ns[a0])), body=inline,
+                orelse=_call(_load('_apply'), self.expr(a0, scope),
+                             _list(args)))
+        return _call(_load('_apply'), self.expr(a0, scope), _list(args))
+
+    def tail(self, form, scope):
+        # Statements that return the value of form.
+        if types._list_Q(form):
+            try:
+                form = self.expand(form, scope)
+            except Exception:
+                return [pyast.Return(value=self.fallback(form, scope))]
+        if not types._list_Q(form) or len(form) == 0:
+            return [pyast.Return(value=self.expr(form, scope))]
+        try:
+            a0 = self.special(form, scope)
+        except NeedsEnv:
+            return [pyast.Return(value=self.fallback(form, scope))]
+        if a0 == 'if':
+            return [pyast.If(
+                test=self.truthy(self.expr(form[1], scope)),
+                body=self.tail(form[2], scope),
+                orelse=self.tail(form[3], scope) if len(form) > 3
+                       else [pyast.Return(value=_const(None))])]
+        elif a0 == 'do':
+            return ([pyast.Expr(value=self.expr(x, scope))
+                     for x in form[1:-1]] + self.tail(form[-1], scope))
+        elif a0 == 'let*':
+            try:
+                values, inner = self.let_bindings(form, scope)
+            except NeedsEnv:
+                return [pyast.Return(value=self.fallback(form, scope))]
+            return ([_assign(name, v) for name, v in values] +
+                    self.tail(form[2], inner))
+        elif a0 == 'quasiquote':
+            return self.tail(self.transpiler.quasiquote(form[1]), scope)
+        elif a0 is not None:
+            return [pyast.Return(value=self.expr(form, scope))]
+
+        f, args = self.temp(), self.temp()
+        nargs = len(form) - 1
+        stmts = [_assign(f, self.expr(form[0], scope)),
+                 _assign(args, _tuple(self.expr(x, scope) for x in form[1:]))]
+        # A call to the function itself rebinds the parameters and loops.
+        values = [_index(_load(args), _const(i)) if i < nargs else _const(None)
+                  for i in range(len(self.fixed))]
+        if self.rest:
+            values.append(_call(_load('_List'), _index(
+                _load(args), pyast.Slice(lower=_const(len(self.fixed)),
+                                         upper=None, step=None))))
+        rebind = [pyast.Continue()]
+        if values:
+            rebind.insert(0, pyast.Assign(
+                targets=[pyast.Tuple(elts=[_store(p) for p in self.params],
+                                     ctx=pyast.Store())],
+                value=_tuple(values)))
+        stmts.append(pyast.If(test=_is(_load(f), _load('_self')),
+                              body=rebind, orelse=[]))
+        stmts.append(pyast.Return(value=_call(_load('_tail'), _load(f),
+                                              _load(args))))
+        return stmts
+
+    def translate(self, params, body):
+        # Returns the module defining _factory(_env, _self), which returns
+        # the Python function for a closure over _env.
+        fixed, rest = _split_params(params)
+        scope = {}
+        for p in fixed + ([rest] if rest else []):
+            scope[p] = self.local()
+        self.fixed = fixed
+        self.rest = rest
+        self.params = [scope[p] for p in fixed] + ([scope[rest]] if rest else [])
+
+        stmts = []
+        if rest:
+            stmts.append(_assign(scope[rest],
+                                 _call(_load('_List'), _load(scope[rest]))))
+        stmts.append(pyast.While(test=_const(True),
+                                 body=self.tail(body, scope), orelse=[]))
+        arguments = pyast.arguments(
+            posonlyargs=[], args=[pyast.arg(arg=scope[p]) for p in fixed],
+            vararg=pyast.arg(arg=scope[rest] if rest else '_'),
+            kwonlyargs=[], kw_defaults=[], kwarg=None,
+            defaults=[_const(None) for p in fixed])
+        inner = pyast.FunctionDef(name='_body', args=arguments, body=stmts,
+                                  decorator_list=[], returns=None)
+        factory = pyast.FunctionDef(
+            name='_factory',
+            args=pyast.arguments(
+                posonlyargs=[], args=[pyast.arg(arg='_env'),
+                                      pyast.arg(arg='_self')],
+                vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None,
+                defaults=[]),
+            body=[_assign('_get', pyast.Attribute(
+                      value=_load('_env'), attr='get', ctx=pyast.Load())),
+                  inner, pyast.Return(value=_load('_body'))],
+            decorator_list=[], returns=None)
+        return pyast.fix_missing_locations(
+            pyast.Module(body=[factory], type_ignores=[]))
+
+class Transpiler():
+    def __init__(self, EVAL, quasiquote, count_call, hot_calls):
+        # count_call(f) counts a call of f and returns how many there have
+        # been, those made before the transpiler was loaded among them.
+        self.EVAL = EVAL
+        self.quasiquote = quasiquote
+        self.count_call = count_call
+        self.hot_calls = hot_calls
+        self.enabled = sys.version_info >= (3, 9)
+        self.factories = {}
+        # Every symbol some compiled code looked up at the head of a form,
+        # and a count of the times one of them has been bound again since.
+        self.head_names = set()
+        self.generation = 0
+
+    def compiled(self, f):
+        """Returns the Python function that runs the Mal function f, or
+        None while f is still interpreted."""
+        code = getattr(f, '__compiled__', None)
+        if code is None:
+            calls = self.count_call(f)
+            if calls == 1:
+                # A closure over a fn* form that is compiled already
+                # starts out compiled too.
+                entry = self.factory(f, self.key(f))
+                if entry:
+                    code = self.install(f, *entry)
+            elif calls >= self.hot_calls:
+                code = self.compile(f)
+        elif code and f.__generation__ != self.generation:
+            # Some head symbol has been bound again since f was compiled:
+            # if it is one of f's, f is compiled again.
+            if _expanded_alike(f.__env__, f.__heads__):
+                f.__generation__ = self.generation
+            else:
+                code = self.compile(f)
+        return code
+
+    def rebound(self, name):
+        """Called when name is bound by def! or defmacro!, for compiled
+        code whose macro expansion depended on what name was."""
+        if name in self.head_names:
+            self.generation += 1
+
+    def install(self, f, factory, heads):
+        code = f.__compiled__ = factory(f.__env__, f)
+        f.__heads__ = heads
+        f.__generation__ = self.generation
+        self.head_names.update(heads)
+        return code
+
+    def key(self, f):
+        try:
+            key = (_key(f.__params__), _key(f.__ast__))
+            hash(key)
+            return key
+        except TypeError:
+            return None
+
+    def factory(self, f, key):
+        # The cached (factory, heads) for f's fn* form, if the macros it
+        # was expanded with are the ones f's env has too.
+        entry = self.factories.get(key)
+        if entry is None or not _expanded_alike(f.__env__, entry[1]):
+            return None
+        return entry
+
+    def compile(self, f):
+        """Compiles f, or finds code for its fn* form that is compiled
+        already, and returns it, or False if f can't be compiled."""
+        global pyast
+        if not self.enabled:
+            f.__compiled__ = False
+            return False
+        if pyast is None:
+            import ast as pyast
+        key = self.key(f)
+        entry = self.factory(f, key)
+        if not entry:
+            fn = Function(self, f.__env__)
+            try:
+                module = fn.translate(f.__params__, f.__ast__)
+            except (Unsupported, RecursionError):
+                f.__compiled__ = False
+                return False
+            namespace = {
+                '_k': fn.consts, '_apply': self.apply, '_tail': _tail,
+                '_List': types.List, '_vector': types._vector,
+                '_Hash_Map': types.Hash_Map, '_function': types._function,
+                '_EVAL': self.EVAL, '_Env': Env}
+            exec(compile(module, '<mal>', 'exec'), namespace)
+            entry = (namespace['_factory'], fn.heads)
+            if key is not None:
+                self.factories[key] = entry
+        return self.install(f, *entry)
+
+    def run(self, f, args):
+        """Calls f with the list args, running the tail calls it returns,
+        up to one of a function that isn't compiled: that call is returned
+        as a TailCall, for EVAL to run in its own loop rather than nested
+        in this one. args is emptied, so that nothing here holds on to the
+        arguments (the head of a lazy sequence f walks, say) while f runs."""
+        while True:
+            code = hasattr(f, '__ast__') and self.compiled(f)
+            if not code:
+                return TailCall(f, args)
+            result = _call_consuming(code, args)
+            if type(result) is not TailCall:
+                return result
+            f, args = result.f, list(result.args)
+            result = None
+
+    def apply(self, f, args):
+        """Calls f with the list args, as run does, but makes a call of a
+        function that isn't compiled itself. This is run's loop over again,
+        as compiled code calls it for every call that isn't a tail call."""
+        while True:
+            code = hasattr(f, '__ast__') and self.compiled(f)
+            if not code:
+                return f(*args)
+            result = _call_consuming(code, args)
+            if type(result) is not TailCall:
+                return result
+            f, args = result.f, list(result.args)
+            result = None